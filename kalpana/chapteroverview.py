@@ -15,14 +15,15 @@
 # You should have received a copy of the GNU General Public License
 # along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
 
-from itertools import zip_longest
-from typing import Iterable, List, Optional, Tuple, cast
+from bisect import bisect_right
+from itertools import accumulate, zip_longest
+from typing import Dict, Iterable, List, Optional, Set, Tuple, cast
 
-from libsyntyche.widgets import Signal1
-from PyQt5 import QtGui, QtWidgets
+from libsyntyche.widgets import Signal1, Signal2, mk_signal2
+from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt, pyqtProperty  # type: ignore
 
-from .chapters import Chapter, Section
+from .chapters import Chapter, ChapterIndex, Section
 
 
 class SectionItem(QtWidgets.QFrame):
@@ -44,8 +45,21 @@ class SectionItem(QtWidgets.QFrame):
 
 
 class ChapterItem(QtWidgets.QFrame):
+    """
+    One chapter in the overview.
 
-    def __init__(self, parent: 'ChapterOverview', num: int) -> None:
+    The overview reuses the same items for different chapters when it's
+    scrolled, so everything about the chapter is set in set_data.
+
+    The item's state property is complete, wip or not-started, and the
+    overview's stylesheet colors it. The colors themselves are set in the
+    main stylesheet as qproperties of ChapterItem.
+    """
+
+    # The index of the chapter and whether it's expanded now
+    expanded_changed = mk_signal2(int, bool)
+
+    def __init__(self, parent: QtWidgets.QWidget) -> None:
         super().__init__(parent)
 
         def label(name: str, layout: QtWidgets.QBoxLayout,
@@ -61,7 +75,7 @@ class ChapterItem(QtWidgets.QFrame):
         self._complete_color = QtGui.QColor(Qt.white)
         self._wip_color = QtGui.QColor(Qt.white)
         self._not_started_color = QtGui.QColor(Qt.white)
-        self.index = num
+        self.index = -1
         layout = QtWidgets.QVBoxLayout(self)
         # Top row
         top_row = QtWidgets.QHBoxLayout()
@@ -74,7 +88,6 @@ class ChapterItem(QtWidgets.QFrame):
         cast(Signal1[bool],
              self.expand_button.toggled).connect(self.toggle)
         top_row.addWidget(self.expand_button)
-        self.num.setText(str(num))
         self.title = label('title', top_row, word_wrap=False)
         self.length = label('length', top_row)
         top_row.addStretch(1)
@@ -110,31 +123,39 @@ class ChapterItem(QtWidgets.QFrame):
         self._not_started_color = color
 
     def toggle(self, expand: bool) -> None:
+        changed = expand != self.expanded
         self.expanded = expand
         self.expand_button.setText('-' if expand else '+')
         for label in [self.desc, self.tags, self.time]:
             label.setVisible(expand and bool(label.text().strip()))
         for item in self.section_items:
             item.setVisible(expand)
+        if changed:
+            self.expanded_changed.emit(self.index, expand)
 
-    def set_data(self, chapter: Chapter, update_stylesheet: bool,
+    def update_state(self, chapter: Chapter) -> None:
+        if chapter.complete:
+            state = 'complete'
+        elif chapter.word_count:
+            state = 'wip'
+        else:
+            state = 'not-started'
+        if state != self.property('state'):
+            self.setProperty('state', state)
+            # The stylesheet only notices the new state when it's reapplied
+            for widget in [self] + self.findChildren(QtWidgets.QWidget):
+                widget.style().unpolish(widget)
+                widget.style().polish(widget)
+
+    def set_data(self, index: int, chapter: Chapter, expanded: bool,
                  force_refresh: bool) -> None:
-        if update_stylesheet:
-            # This needs to be here to hack in colors for the various
-            # chapter states, but it's a slow operation and it gets
-            # overwritten so it should only be run when entering the
-            # chapter overview.
-            if chapter.complete:
-                c = self._complete_color
-            elif chapter.word_count:
-                c = self._wip_color
-            else:
-                c = self._not_started_color
-            self.setStyleSheet(f'color: rgba({c.red()}, {c.green()}, '
-                               f'{c.blue()}, {c.alpha()});')
-        if not force_refresh and self.chapter == chapter:
+        if not force_refresh and self.index == index \
+                and self.chapter is chapter and self.expanded == expanded:
             return
+        self.update_state(chapter)
+        self.index = index
         self.chapter = chapter
+        self.expanded = expanded
         title = chapter.title
         length = chapter.word_count
         time = chapter.time
@@ -146,6 +167,7 @@ class ChapterItem(QtWidgets.QFrame):
         self.expand_button.setChecked(self.expanded)
         complete_text = ' ✓' if complete else ''
         # Top row
+        self.num.setText(str(index))
         self.title.setText(f'Chapter {title or self.index}{complete_text}')
         self.length.setText(f'({length})')
         self.length.show()
@@ -187,40 +209,225 @@ class ChapterItem(QtWidgets.QFrame):
         self.toggle(self.expanded)
 
 
-class ChapterOverview(QtWidgets.QScrollArea):
-    def __init__(self, parent: QtWidgets.QWidget) -> None:
+class ChapterOverview(QtWidgets.QAbstractScrollArea):
+    """
+    A list of all chapters, where only the visible ones have widgets.
+
+    The chapters are read straight from the chapter index, which sends
+    notices when chapters change or are inserted or removed. Only the
+    visible chapters that have changed are updated.
+
+    The height of each chapter is measured the first time it's shown and
+    remembered until it changes. Until then it's assumed to be as tall as
+    the first chapter that was measured.
+    """
+
+    # Empty space below the last chapter
+    bottom_margin = 300
+
+    def __init__(self, parent: QtWidgets.QWidget,
+                 chapter_index: ChapterIndex) -> None:
         super().__init__(parent)
-        self.empty = True
-        self.container = QtWidgets.QFrame(self)
-        self.container.setObjectName('container')
-        self.setWidget(self.container)
-        self.setWidgetResizable(True)
-        layout = QtWidgets.QVBoxLayout(self.container)
-        layout.setContentsMargins(0, 0, 0, 0)
-        layout.setSpacing(0)
-        layout.addSpacerItem(QtWidgets.QSpacerItem(
-            0, 300, vPolicy=QtWidgets.QSizePolicy.MinimumExpanding
-        ))
-        self.chapter_items: List[ChapterItem] = []
+        self.chapter_index = chapter_index
+        self.viewport().setObjectName('container')
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.verticalScrollBar().setSingleStep(20)
+        # Every chapter except the first one (the text before the first
+        # chapter line) has a row
+        self.expanded_chapters: Set[int] = set()
+        self.changed_rows: Set[int] = set()
+        # The height of every row, or None if it hasn't been measured
+        self.row_heights: List[Optional[int]] = []
+        self.row_offsets: List[int] = [0]
+        self.row_offsets_outdated = False
+        self.default_row_height = 0
+        self.row_width = -1
+        # The items of the visible rows, and hidden items to reuse
+        self.visible_items: Dict[int, ChapterItem] = {}
+        self.unused_items: List[ChapterItem] = []
+        self.laying_out = False
+        # Change notices are applied once per event loop iteration
+        self.layout_timer = QtCore.QTimer(self)
+        self.layout_timer.setInterval(0)
+        self.layout_timer.setSingleShot(True)
+        self.layout_timer.timeout.connect(self.layout_items)
         self.show()
 
-    def load_chapter_data(self, chapters: List[Chapter],
-                          update_stylesheet: bool = False,
-                          force_refresh: bool = False) -> None:
-        self.empty = not bool(chapters[1:])
-        ziplist: Iterable[Tuple[int, Tuple[Optional[Chapter],
-                                           Optional[ChapterItem]]]] \
-            = enumerate(zip_longest(chapters[1:], self.chapter_items))
-        for n, (chapter, item) in ziplist:
-            if chapter is None:
-                if item:
-                    item.hide()
+    @property
+    def empty(self) -> bool:
+        return len(self.chapter_index.chapters) <= 1
+
+    def update_state_colors(self) -> None:
+        """Color the chapters with the colors in the main stylesheet."""
+        item = self.get_unused_item()
+        item.ensurePolished()
+        self.unused_items.append(item)
+        rules = []
+        for state, c in [('complete', item.complete_color),
+                         ('wip', item.wip_color),
+                         ('not-started', item.not_started_color)]:
+            selector = f'ChapterItem[state="{state}"]'
+            rules.append(f'{selector}, {selector} * {{ color: rgba('
+                         f'{c.red()}, {c.green()}, {c.blue()}, {c.alpha()}); }}')
+        css = '\n'.join(rules)
+        # This makes every item apply the stylesheet again, which is slow
+        if css != self.viewport().styleSheet():
+            self.viewport().setStyleSheet(css)
+
+    @staticmethod
+    def chapter_rows(first: int, count: int) -> Tuple[int, int]:
+        """Return the first row and the number of rows of some chapters."""
+        start = max(0, first - 1)
+        return start, max(0, first + count - 1 - start)
+
+    def chapters_changed(self, first: int, count: int) -> None:
+        start, count = self.chapter_rows(first, count)
+        self.changed_rows.update(range(start, start + count))
+        self.schedule_layout()
+
+    def chapters_inserted(self, first: int, count: int) -> None:
+        start, count = self.chapter_rows(first, count)
+        self.row_heights[start:start] = [None] * count
+        self.shift_rows(start, count)
+
+    def chapters_removed(self, first: int, count: int) -> None:
+        start, count = self.chapter_rows(first, count)
+        del self.row_heights[start:start + count]
+        self.shift_rows(start, -count)
+
+    def shift_rows(self, start: int, diff: int) -> None:
+        """Move the rows after start, dropping any removed ones."""
+        removed = range(start, start - diff)
+
+        def shift(rows: Iterable[int]) -> Set[int]:
+            return {row + diff if row >= start else row
+                    for row in rows if row not in removed}
+        self.expanded_chapters = shift(self.expanded_chapters)
+        self.changed_rows = shift(self.changed_rows)
+        visible_items = {}
+        for row, item in self.visible_items.items():
+            if row in removed:
+                item.hide()
+                self.unused_items.append(item)
             else:
-                if item is None:
-                    item = ChapterItem(self, n)
-                    self.chapter_items.append(item)
-                    cast(QtWidgets.QVBoxLayout,
-                         self.container.layout()).insertWidget(n, item)
-                item.set_data(chapter, update_stylesheet=update_stylesheet,
-                              force_refresh=force_refresh)
-                item.show()
+                visible_items[row + diff if row >= start else row] = item
+        self.visible_items = visible_items
+        self.row_offsets_outdated = True
+        self.schedule_layout()
+
+    def schedule_layout(self) -> None:
+        # Hidden rows are updated when the overview is shown again
+        if self.isVisible():
+            self.layout_timer.start()
+
+    def set_expanded(self, row: int, expanded: bool) -> None:
+        if expanded:
+            self.expanded_chapters.add(row)
+        else:
+            self.expanded_chapters.discard(row)
+        self.changed_rows.add(row)
+        self.layout_items()
+
+    def update_row_offsets(self) -> None:
+        self.row_offsets = [0] + list(accumulate(
+            self.default_row_height if height is None else height
+            for height in self.row_heights))
+        self.row_offsets_outdated = False
+
+    def row_height(self, item: ChapterItem, width: int) -> int:
+        if item.hasHeightForWidth():
+            return int(item.heightForWidth(width))
+        return int(item.sizeHint().height())
+
+    def get_unused_item(self) -> ChapterItem:
+        if self.unused_items:
+            return self.unused_items.pop()
+        item = ChapterItem(self.viewport())
+        item.hide()
+        cast(Signal2[int, bool],
+             item.expanded_changed).connect(self.set_expanded)
+        return item
+
+    def layout_items(self) -> None:
+        """Give the visible rows items and put them in place."""
+        if self.laying_out:
+            return
+        self.laying_out = True
+        try:
+            self.layout_timer.stop()
+            row_count = max(0, len(self.chapter_index.chapters) - 1)
+            if len(self.row_heights) != row_count:
+                # This only happens if a change notice was missed
+                self.row_heights = [None] * row_count
+                self.changed_rows = set(range(row_count))
+                self.row_offsets_outdated = True
+            width = self.viewport().width()
+            if width != self.row_width:
+                # Everything with word wrap has a new height
+                self.row_width = width
+                self.row_heights = [None] * len(self.row_heights)
+                self.row_offsets_outdated = True
+            if self.row_offsets_outdated:
+                self.update_row_offsets()
+            scrollbar = self.verticalScrollBar()
+            while True:
+                top = scrollbar.value()
+                self.place_items(top, width)
+                total_height = self.row_offsets[-1] + self.bottom_margin
+                viewport_height = self.viewport().height()
+                scrollbar.setPageStep(viewport_height)
+                scrollbar.setRange(0, max(0, total_height - viewport_height))
+                # Measuring the items can change the scroll position
+                if scrollbar.value() == top:
+                    break
+        finally:
+            self.laying_out = False
+
+    def place_items(self, top: int, width: int) -> None:
+        chapters = self.chapter_index.chapters
+        bottom = top + self.viewport().height()
+        if self.default_row_height:
+            first = max(0, bisect_right(self.row_offsets, top) - 1)
+        else:
+            # Nothing has been measured yet, so every row is 0 pixels high
+            first = 0
+        old_items = self.visible_items
+        self.visible_items = {}
+        heights_changed = False
+        y = self.row_offsets[first]
+        n = first
+        while n < len(self.row_heights) and y < bottom:
+            item = old_items.pop(n, None) or self.get_unused_item()
+            changed = n in self.changed_rows
+            self.changed_rows.discard(n)
+            item.set_data(n, chapters[n + 1], n in self.expanded_chapters,
+                          force_refresh=changed)
+            height = self.row_heights[n]
+            if height is None or changed:
+                new_height = self.row_height(item, width)
+                if new_height != height:
+                    self.row_heights[n] = height = new_height
+                    heights_changed = True
+                if not self.default_row_height:
+                    self.default_row_height = height
+            item.setGeometry(0, y - top, width, height)
+            item.show()
+            self.visible_items[n] = item
+            y += height
+            n += 1
+        for item in old_items.values():
+            item.hide()
+            self.unused_items.append(item)
+        if heights_changed:
+            self.update_row_offsets()
+
+    def scrollContentsBy(self, dx: int, dy: int) -> None:
+        self.layout_items()
+
+    def resizeEvent(self, event: QtGui.QResizeEvent) -> None:
+        super().resizeEvent(event)
+        self.layout_items()
+
+    def showEvent(self, event: QtGui.QShowEvent) -> None:
+        super().showEvent(event)
+        self.layout_items()
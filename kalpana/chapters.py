@@ -21,13 +21,25 @@ The internal representation of the chapters.
 This should not import/depend on any GUI module (such as chapteroverview).
 """
 
-import re
+import logging
+import queue
+import threading
+from bisect import bisect_right
 from itertools import accumulate
-from typing import Any, Dict, List, Optional, Set
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Set, Tuple)
 
+from libsyntyche.widgets import mk_signal2
 from PyQt5 import QtCore, QtGui
 
-from .common import KalpanaObject, TextBlockState
+from .common import KalpanaObject, TextBlockData, TextBlockState
+from .highlighter import Highlighter
+
+logger = logging.getLogger(__name__)
+
+# Lines whose words aren't included in the word counts
+UNCOUNTED_LINES = (TextBlockState.CHAPTER | TextBlockState.SECTION
+                   | TextBlockState.CHAPTERMETA)
 
 
 class Section:
@@ -71,7 +83,10 @@ class Chapter:
         elif state & TextBlockState.SECTION:
             section_lines = list(accumulate([self.metadata_line_count]
                                             + [s.line_count for s in self.sections]))
-            self.sections[section_lines.index(line_num)].desc = line.rstrip()[2:-2].strip()
+            # The first section is empty if the section line comes right
+            # after the metadata, so use the last section starting here
+            section_num = bisect_right(section_lines, line_num) - 1
+            self.sections[section_num].desc = line.rstrip()[2:-2].strip()
         elif state & TextBlockState.DESC:
             self.desc = line.rstrip()[2:-2].strip()
         elif state & TextBlockState.TIME:
@@ -128,16 +143,208 @@ class Chapter:
             return False
 
 
+def merge_changes(first: Tuple[int, int, int],
+                  second: Tuple[int, int, int]) -> Tuple[int, int, int]:
+    """
+    Merge two consecutive document changes into one.
+
+    Both changes are (position, chars removed, chars added), like the
+    arguments of QTextDocument.contentsChange. The result covers the area
+    both of them touched, as if it had been replaced in one go.
+    """
+    start, removed, added = first
+    pos, second_removed, second_added = second
+    old_end = start + removed
+    new_end = start + added
+    # Anything outside the first change is the same in the old text
+    end = max(new_end, pos + second_removed)
+    old_end += end - new_end
+    new_end = end + second_added - second_removed
+    if pos < start:
+        start = pos
+    return start, old_end - start, new_end - start
+
+
+def build_index(lines: Iterable[Tuple[str, int, int]], chapter_keyword: str
+                ) -> Tuple[List[Chapter], Dict[int, int]]:
+    """
+    Return the chapters and the non-zero line states of a document.
+
+    Each line is a tuple of (text, line state, indexed word count).
+    """
+    chapters = [Chapter()]
+    current_chunk_start = 0
+    n = -1
+    block_states: Dict[int, int] = {}
+    for n, (line, state, word_count) in enumerate(lines):
+        if state:
+            block_states[n] = state
+        if state & TextBlockState.CHAPTER:
+            chapters[-1].sections[-1].line_count = n - current_chunk_start
+            chapters.append(Chapter())
+            chapters[-1].update_line(state, line, chapter_keyword, -1)
+            current_chunk_start = n
+        elif state & TextBlockState.SECTION:
+            chapters[-1].sections[-1].line_count = n - current_chunk_start
+            chapters[-1].sections.append(Section(
+                desc=line.rstrip()[2:-2].strip()
+            ))
+            current_chunk_start = n
+        elif state & TextBlockState.CHAPTERMETA:
+            chapters[-1].update_line(state, line, chapter_keyword, -1)
+        chapters[-1].sections[-1].word_count += word_count
+    chapters[-1].sections[-1].line_count = n + 1 - current_chunk_start
+    # Shitty hack to fix the metadata line count
+    for c in chapters:
+        metalines = sum(x is not None
+                        for x in [c.title, c.desc, c.tags, c.time])
+        c.metadata_line_count = metalines
+        c.sections[0].line_count -= metalines
+    return chapters, block_states
+
+
+def index_text(text: str, chapter_keyword: str
+               ) -> Tuple[List[Chapter], Dict[int, int]]:
+    """
+    Return the chapters and the non-zero line states of a plain text.
+
+    The line states are worked out the same way the highlighter does it, so
+    this gives the same result as indexing a highlighted document, without
+    needing the document.
+    """
+    def lines() -> Iterator[Tuple[str, int, int]]:
+        state = 0
+        for line in text.split('\n'):
+            state = (Highlighter.get_line_format(line, chapter_keyword, state)
+                     & TextBlockState.LINEFORMATS)
+            yield line, state, 0 if state & UNCOUNTED_LINES else len(line.split())
+    return build_index(lines(), chapter_keyword)
+
+
+def _index_texts_in_background(
+        requests: 'queue.Queue[Optional[Tuple[str, str]]]',
+        text_indexed: Callable[[List[Chapter], Dict[int, int]], None]
+) -> None:
+    """
+    Index texts sent from the GUI thread, in the order they're sent.
+
+    Each request is a tuple of (text, chapter keyword). An empty list of
+    chapters is passed to text_indexed if the indexing failed. None stops
+    the thread.
+    """
+    while True:
+        request = requests.get()
+        if request is None:
+            requests.task_done()
+            return
+        text, chapter_keyword = request
+        try:
+            chapters, block_states = index_text(text, chapter_keyword)
+        except Exception:
+            logger.exception('Failed to index the text')
+            chapters, block_states = [], {}
+        text_indexed(chapters, block_states)
+        requests.task_done()
+
+
+class FenwickTree:
+    """
+    A binary indexed tree of ints.
+
+    Updating a value and getting the sum of all values up to a certain index
+    are both O(log n), as is finding which index a cumulative sum ends up in.
+    """
+
+    def __init__(self, values: Iterable[int] = ()) -> None:
+        tree = [0] + list(values)
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def __len__(self) -> int:
+        return len(self._tree) - 1
+
+    def add(self, index: int, delta: int) -> None:
+        """Add delta to the value at index."""
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, index: int) -> int:
+        """Return the sum of all values before index."""
+        total = 0
+        i = index
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def search(self, target: int) -> int:
+        """
+        Return the first index where the cumulative sum exceeds target.
+
+        Put differently, this is how many values fit before the sum goes
+        above target. If the total sum is not above target, the length of
+        the tree is returned. All values are assumed to be non-negative.
+        """
+        pos = 0
+        step = 1 << (len(self).bit_length() - 1) if len(self) else 0
+        while step:
+            i = pos + step
+            if i < len(self._tree) and self._tree[i] <= target:
+                pos = i
+                target -= self._tree[i]
+            step >>= 1
+        return pos
+
+
 class ChapterIndex(QtCore.QObject, KalpanaObject):
 
+    text_indexed = mk_signal2(list, dict)
+    # Change notices with the first chapter and how many chapters changed,
+    # were inserted or were removed
+    chapters_changed = mk_signal2(int, int)
+    chapters_inserted = mk_signal2(int, int)
+    chapters_removed = mk_signal2(int, int)
+
     def __init__(self) -> None:
         super().__init__()
         self.kalpana_settings = ['chapter-keyword']
         self.chapters: List[Chapter] = []
         self.chapter_keyword = 'CHAPTER'
         self._block_count = -1
+        # The document is split into units: every chapter's metadata lines,
+        # followed by each of its sections. Their line counts live in a
+        # fenwick tree so lines can be added or removed in O(log n).
+        self._line_counts = FenwickTree()
+        # (chapter, section) for every unit, with section -1 for metadata
+        self._unit_owners: List[Tuple[int, int]] = []
+        self._chapter_units: List[int] = []
+        # The non-zero line states of each unit, keyed by the line's offset
+        # from the start of the unit. This way only the unit that actually
+        # grows or shrinks has to shift its keys.
         # TODO: maybe actually use TextBlockState here?
-        self._block_states: Dict[int, int] = {}
+        self._unit_states: List[Dict[int, int]] = []
+        # Units where lines have been removed, which means the word counts
+        # of the removed blocks are gone and the unit has to be recounted
+        self._dirty_word_counts: Set[int] = set()
+        # True if the index wasn't made from the document's blocks, which
+        # means their cached word counts can't be trusted
+        self._uncounted_blocks = False
+        self.total_word_count = 0
+        # Whole texts (like newly opened files) are indexed in a thread
+        self.pending_text_indexes = 0
+        self.text_indexed.connect(self._text_indexed)
+        self.index_requests: 'queue.Queue[Optional[Tuple[str, str]]]' = \
+            queue.Queue()
+        self.index_thread = threading.Thread(
+            target=_index_texts_in_background,
+            args=(self.index_requests, self.text_indexed.emit),
+            daemon=True)
+        self.index_thread.start()
 
     def setting_changed(self, name: str, new_value: Any) -> None:
         if name == 'chapter-keyword':
@@ -148,49 +355,68 @@ class ChapterIndex(QtCore.QObject, KalpanaObject):
                           pos: int, removed: int, added: int) -> bool:
         if not self.chapters:
             return self.full_line_index_update(document)
-
-        def doc_text() -> str:
-            # Dump this here to fix the UTF-16 garbage
-            return re.sub(r'[\uffff-\U0010ffff]', 'xx', document.toPlainText())
         old_block_count = self._block_count
         new_block_count = self._block_count = document.blockCount()
         line_diff = new_block_count - old_block_count
-        special_lines = self.special_lines()
         block = document.findBlock(pos)
         state = block.userState() & TextBlockState.LINEFORMATS
         line_num = block.blockNumber()
+
+        def is_single_line_change() -> bool:
+            # Only look at the added text, never the whole document
+            if document.findBlock(pos + added) != block:
+                return False
+            added_text = QtGui.QTextCursor(block)
+            added_text.setPosition(pos)
+            added_text.setPosition(pos + added, QtGui.QTextCursor.KeepAnchor)
+            return '\u2028' not in added_text.selectedText()
+
+        def update_block_word_count() -> None:
+            data = block.userData()
+            if isinstance(data, TextBlockData) and data.revision >= 0:
+                self._update_word_counts(block, block)
+                return
+            # A new block means that merged changes split the line and
+            # joined it again, and the words of the removed block are
+            # still in the index, so the whole unit has to be recounted
+            result = self._find_unit(line_num)
+            if result is not None:
+                self._dirty_word_counts.add(result[0])
         # If only one line has been modified, try to update that data
         if not line_diff \
                 and ((added and not removed) or (removed and not added)
-                     or (added and removed
-                         and '\n' not in doc_text()[pos:pos+added])):
-            if state and state == self._block_states.get(line_num):
+                     or (added and removed and is_single_line_change())):
+            if state and state == self._block_state(line_num):
                 chapter_num = self.which_chapter(line_num)
                 offset = line_num - self.get_chapter_line(chapter_num)
-                # TODO: recalc word count?
-                # or just make it lazy maybe
                 self.chapters[chapter_num].update_line(
                     state, block.text(), self.chapter_keyword, offset)
+                self.chapters_changed.emit(chapter_num, 1)
+                update_block_word_count()
                 return True
-            elif state == self._block_states.get(line_num) == 0:
+            elif state == self._block_state(line_num) == 0:
+                update_block_word_count()
                 return False
         # One line is shifted down irrelevantly
-        if line_diff == 1 and added == 1 and line_num in special_lines:
+        if line_diff == 1 and added == 1 and self.is_special_line(line_num):
             new_state = block.next().userState() & TextBlockState.LINEFORMATS
-            if not state and new_state == self._block_states.get(line_num) \
+            if not state and new_state == self._block_state(line_num) \
                 and (new_state & TextBlockState.CHAPTER
                      or new_state & TextBlockState.SECTION):
                 success = self.add_remove_lines(line_num, line_diff)
                 if success:
+                    self._update_word_counts(block, block.next())
                     return True
         # Only added stuff which means we don't have to care about unknowns
         if added and not removed \
-                and line_diff and line_num not in special_lines:
+                and line_diff and not self.is_special_line(line_num):
             start_block = document.findBlock(pos)
             clean = True
             block = start_block
+            # The block where the added text ends is included, since the
+            # rest of a split line might have become a special line
             while block.isValid():
-                if block.position() >= pos + added:
+                if block.position() > pos + added:
                     break
                 if block.userState() & TextBlockState.LINEFORMATS:
                     clean = False
@@ -200,97 +426,303 @@ class ChapterIndex(QtCore.QObject, KalpanaObject):
             if clean:
                 success = self.add_remove_lines(line_num, line_diff)
                 if success:
+                    self._update_word_counts(
+                        start_block, document.findBlock(pos + added))
                     return True
         # Prolly spamming backspace, nbd
         if removed and not added and line_diff:
-            removed_lines = set(range(line_num, line_num + 1 - line_diff))
-            if not state and not removed_lines.intersection(special_lines):
+            if not state and not self.touches_special_line(
+                    line_num, line_num - line_diff):
                 success = self.add_remove_lines(line_num, line_diff)
                 if success:
+                    result = self._find_unit(line_num)
+                    if result is not None:
+                        self._dirty_word_counts.add(result[0])
                     return True
         return self.full_line_index_update(document)
 
     def full_line_index_update(self, document: QtGui.QTextDocument) -> bool:
-        block = document.firstBlock()
-        ch_str = self.chapter_keyword
-        chapters = [Chapter()]
-        current_chunk_start = 0
-        n = 0
-        self._block_states.clear()
+        def lines() -> Iterator[Tuple[str, int, int]]:
+            block = document.firstBlock()
+            while block.isValid():
+                state = block.userState() & TextBlockState.LINEFORMATS
+                yield (block.text(), state,
+                       self._refresh_word_count(block, state)[1])
+                block = block.next()
+        chapters, block_states = build_index(lines(), self.chapter_keyword)
+        self._set_index(chapters, block_states)
+        self._uncounted_blocks = False
+        return True
+
+    def index_text_in_background(self, text: str) -> None:
+        """
+        Index a text that is about to replace the document's text.
+
+        The new index replaces the current one as soon as it's done, so any
+        changes to the document after the text is set have to wait until
+        then before they're applied to the index.
+        """
+        self.pending_text_indexes += 1
+        self.index_requests.put((text, self.chapter_keyword))
+
+    def _text_indexed(self, chapters: List[Chapter],
+                      block_states: Dict[int, int]) -> None:
+        self.pending_text_indexes -= 1
+        # Only the most recent text is still in the document
+        if self.pending_text_indexes:
+            return
+        if not chapters:
+            self.error("Couldn't index the text, try editing it")
+            old_chapters = self.chapters
+            self.chapters = []
+            self._notify_changes(old_chapters)
+            return
+        self._set_index(chapters, block_states)
+        # The blocks' own word counts haven't been cached
+        self._uncounted_blocks = True
+
+    def close(self) -> None:
+        """Stop the background thread once the pending texts are indexed."""
+        self.index_requests.put(None)
+        self.index_thread.join()
+
+    def wait_for_text_index(self) -> None:
+        """Block until the text being indexed in the background is done."""
+        if self.pending_text_indexes:
+            self.index_requests.join()
+            # Apply the new index now instead of in the event loop
+            QtCore.QCoreApplication.sendPostedEvents(None, QtCore.QEvent.MetaCall)
+
+    def _set_index(self, chapters: List[Chapter],
+                   block_states: Dict[int, int]) -> None:
+        old_chapters = self.chapters
+        self.chapters = chapters
+        self._block_count = sum(c.line_count for c in chapters)
+        self._index_units(block_states)
+        self._dirty_word_counts.clear()
+        self.total_word_count = sum(c.word_count for c in chapters)
+        self._notify_changes(old_chapters)
+
+    def _notify_changes(self, old_chapters: List[Chapter]) -> None:
+        """Send change notices for the difference from the old chapters."""
+        new_chapters = self.chapters
+        # Skip the chapters that are the same at the start and the end
+        start = 0
+        while start < min(len(old_chapters), len(new_chapters)) \
+                and old_chapters[start] == new_chapters[start]:
+            start += 1
+        old_end = len(old_chapters)
+        new_end = len(new_chapters)
+        while old_end > start and new_end > start \
+                and old_chapters[old_end - 1] == new_chapters[new_end - 1]:
+            old_end -= 1
+            new_end -= 1
+        changed = min(old_end, new_end) - start
+        if changed:
+            self.chapters_changed.emit(start, changed)
+        if old_end > new_end:
+            self.chapters_removed.emit(start + changed, old_end - new_end)
+        elif new_end > old_end:
+            self.chapters_inserted.emit(start + changed, new_end - old_end)
+
+    @staticmethod
+    def _refresh_word_count(block: QtGui.QTextBlock,
+                            state: int) -> Tuple[int, int]:
+        """
+        Update a block's cached word count.
+
+        Only blocks that have changed since last time are actually recounted.
+        Return how many words the block contributed to the index before
+        and after the update.
+        """
+        data = block.userData()
+        if not isinstance(data, TextBlockData):
+            data = TextBlockData()
+            block.setUserData(data)
+        if data.revision != block.revision() or data.length != block.length():
+            data.revision = block.revision()
+            data.length = block.length()
+            data.word_count = len(block.text().split())
+        old_count = data.indexed_word_count
+        if state & UNCOUNTED_LINES:
+            data.indexed_word_count = 0
+        else:
+            data.indexed_word_count = data.word_count
+        return old_count, data.indexed_word_count
+
+    def _update_word_counts(self, first_block: QtGui.QTextBlock,
+                            last_block: QtGui.QTextBlock) -> None:
+        """Apply the word count changes of a range of blocks."""
+        block = first_block
         while block.isValid():
-            line = block.text()
-            state = block.userState()
-            self._block_states[n] = state & TextBlockState.LINEFORMATS
-            if state & TextBlockState.CHAPTER:
-                chapters[-1].sections[-1].line_count = n - current_chunk_start
-                chapters.append(Chapter())
-                chapters[-1].update_line(state, line, ch_str, -1)
-                current_chunk_start = n
-            elif state & TextBlockState.SECTION:
-                chapters[-1].sections[-1].line_count = n - current_chunk_start
-                chapters[-1].sections.append(Section(
-                    desc=line.rstrip()[2:-2].strip()
-                ))
-                current_chunk_start = n
-            elif state & TextBlockState.CHAPTERMETA:
-                chapters[-1].update_line(state, line, ch_str, -1)
-            else:
-                chapters[-1].sections[-1].word_count += len(line.split())
-            n += 1
+            data = block.userData()
+            was_counted = isinstance(data, TextBlockData) and data.revision >= 0
+            old_count, new_count = self._refresh_word_count(
+                block, block.userState() & TextBlockState.LINEFORMATS)
+            if self._uncounted_blocks and not was_counted:
+                # There's no telling how many of the block's words were in
+                # the index, so the whole unit has to be recounted
+                result = self._find_unit(block.blockNumber())
+                if result is not None:
+                    self._dirty_word_counts.add(result[0])
+            elif new_count != old_count:
+                result = self._find_unit(block.blockNumber())
+                if result is not None:
+                    chapter_num, section_num = self._unit_owners[result[0]]
+                    chapter = self.chapters[chapter_num]
+                    section = chapter.sections[max(0, section_num)]
+                    section.word_count += new_count - old_count
+                    self.total_word_count += new_count - old_count
+                    self.chapters_changed.emit(chapter_num, 1)
+            if block == last_block:
+                break
             block = block.next()
-        chapters[-1].sections[-1].line_count = n - current_chunk_start
-        # Shitty hack to fix the metadata line count
-        for c in chapters:
-            metalines = sum(x is not None
-                            for x in [c.title, c.desc, c.tags, c.time])
-            c.metadata_line_count = metalines
-            c.sections[0].line_count -= metalines
-        self.chapters = chapters
-        return True
+
+    def update_word_counts(self, document: QtGui.QTextDocument) -> None:
+        """
+        Recount the words in all sections where lines have been removed.
+
+        This only has to be done before the word counts are actually used.
+        """
+        for unit in self._dirty_word_counts:
+            chapter_num, section_num = self._unit_owners[unit]
+            if section_num < 0:
+                continue
+            section = self.chapters[chapter_num].sections[section_num]
+            start = self._line_counts.prefix_sum(unit)
+            block = document.findBlockByNumber(start)
+            word_count = 0
+            for _ in range(section.line_count):
+                word_count += self._refresh_word_count(
+                    block, block.userState() & TextBlockState.LINEFORMATS)[1]
+                block = block.next()
+            self.total_word_count += word_count - section.word_count
+            if word_count != section.word_count:
+                section.word_count = word_count
+                self.chapters_changed.emit(chapter_num, 1)
+        self._dirty_word_counts.clear()
+
+    def uncounted_word_count(self, document: QtGui.QTextDocument) -> int:
+        """
+        Return the number of words in the lines left out of the word counts.
+
+        Those are the chapter lines with their metadata and the section
+        lines, which are all at the start of their units, so only a few
+        blocks per chapter have to be looked at.
+        """
+        word_count = 0
+        for unit, (chapter_num, section_num) in enumerate(self._unit_owners):
+            if section_num < 0:
+                line_count = self.chapters[chapter_num].metadata_line_count
+            elif section_num > 0:
+                line_count = 1
+            else:
+                continue
+            block = document.findBlockByNumber(self._line_counts.prefix_sum(unit))
+            for _ in range(line_count):
+                word_count += len(block.text().split())
+                block = block.next()
+        return word_count
+
+    def _index_units(self, block_states: Dict[int, int]) -> None:
+        """Rebuild the unit lookup structures from the chapters."""
+        unit_counts: List[int] = []
+        self._unit_owners = []
+        self._chapter_units = []
+        self._unit_states = []
+        for chapter_num, chapter in enumerate(self.chapters):
+            self._chapter_units.append(len(unit_counts))
+            unit_counts.append(chapter.metadata_line_count)
+            self._unit_owners.append((chapter_num, -1))
+            for section_num, section in enumerate(chapter.sections):
+                unit_counts.append(section.line_count)
+                self._unit_owners.append((chapter_num, section_num))
+        pos = 0
+        for count in unit_counts:
+            self._unit_states.append({n - pos: block_states[n]
+                                      for n in range(pos, pos + count)
+                                      if n in block_states})
+            pos += count
+        self._line_counts = FenwickTree(unit_counts)
+
+    def _find_unit(self, line: int) -> Optional[Tuple[int, int]]:
+        """Return the unit a line is in and the line's offset in it."""
+        unit = self._line_counts.search(line)
+        if unit >= len(self._line_counts):
+            return None
+        return unit, line - self._line_counts.prefix_sum(unit)
+
+    def _block_state(self, line: int) -> Optional[int]:
+        """Return the indexed state of a line, or None if it's unknown."""
+        result = self._find_unit(line)
+        if result is None:
+            return None
+        unit, offset = result
+        return self._unit_states[unit].get(offset, 0)
 
     @property
     def chapter_line_numbers(self) -> List[int]:
-        return [0] + list(accumulate(chapter.line_count
-                                     for chapter in self.chapters))[:-1]
+        return [self._line_counts.prefix_sum(unit)
+                for unit in self._chapter_units]
 
     def get_chapter_line(self, num: int) -> int:
         """Return what line a given chapter begins on."""
-        return self.chapter_line_numbers[num]
+        return self._line_counts.prefix_sum(self._chapter_units[num])
 
-    def special_lines(self) -> List[int]:
-        lines: List[int] = []
-        pos = 0
-        for chapter in self.chapters:
-            lines.extend(range(pos, pos + chapter.metadata_line_count))
-            pos += chapter.metadata_line_count
-            for section in chapter.sections:
-                lines.append(pos)
-                pos += section.line_count
-        return lines
+    def is_special_line(self, line: int) -> bool:
+        """Return True if the line is a chapter metadata or section line."""
+        result = self._find_unit(line)
+        if result is None:
+            return False
+        unit, offset = result
+        return self._unit_owners[unit][1] < 0 or offset == 0
+
+    def touches_special_line(self, first_line: int, last_line: int) -> bool:
+        """Return True if any line in the (inclusive) range is special."""
+        result = self._find_unit(first_line)
+        if result is None:
+            return False
+        unit = result[0]
+        if self.is_special_line(first_line):
+            return True
+        # Every unit starts with a special line
+        return (unit + 1 < len(self._unit_owners)
+                and self._line_counts.prefix_sum(unit + 1) <= last_line)
 
     def which_chapter(self, line: int) -> int:
         """Return which chapter a given line is in."""
         if not self.chapters:
             return 0
-        return next(n for n, chapter_line
-                    in reversed(list(enumerate(self.chapter_line_numbers)))
-                    if line >= chapter_line)
+        result = self._find_unit(max(0, line))
+        if result is None:
+            return len(self.chapters) - 1
+        return self._unit_owners[result[0]][0]
 
     def add_remove_lines(self, line: int, count: int) -> bool:
         if not self.chapters:
             return False
-        pos = 0
-        for n, chapter in enumerate(self.chapters):
-            pos += chapter.metadata_line_count
-            for section in chapter.sections:
-                if pos + section.line_count >= line:
-                    if count < 0 and count <= -section.line_count:
-                        return False
-                    section.line_count += count
-                    self._block_states = {
-                        k + (count if k >= line else 0): v
-                        for k, v in self._block_states.items()
-                    }
-                    return True
-                pos += section.line_count
-        return False
+        # The first section that ends on or after the line owns it
+        unit = self._line_counts.search(line - 1)
+        if unit >= len(self._unit_owners):
+            return False
+        chapter_num, section_num = self._unit_owners[unit]
+        # Metadata lines are never added or removed this way
+        if section_num < 0:
+            unit += 1
+            section_num = 0
+        section = self.chapters[chapter_num].sections[section_num]
+        if count < 0 and count <= -section.line_count:
+            return False
+        section.line_count += count
+        self.chapters_changed.emit(chapter_num, 1)
+        offset = line - self._line_counts.prefix_sum(unit)
+        self._line_counts.add(unit, count)
+        states = self._unit_states[unit]
+        if count > 0:
+            self._unit_states[unit] = {k + (count if k >= offset else 0): v
+                                       for k, v in states.items()}
+        else:
+            self._unit_states[unit] = {k + (count if k >= offset else 0): v
+                                       for k, v in states.items()
+                                       if not offset <= k < offset - count}
+        return True
@@ -23,11 +23,12 @@ This is to avoid potential circular imports.
 import enum
 import logging
 from contextlib import contextmanager
-from typing import Any, Callable, Iterator, List, TypeVar, cast
+from typing import Any, Callable, Iterator, List, Set, TypeVar, cast
 
 from libsyntyche.cli import AutocompletionPattern, Command
 from libsyntyche.widgets import Signal2, Signal3, mk_signal1
 from PyQt5.QtCore import QVariant, pyqtSignal
+from PyQt5.QtGui import QTextBlockUserData
 
 T = TypeVar('T', bound=Callable[..., Any])
 
@@ -130,6 +131,27 @@ class TextBlockState(enum.IntFlag):
     FORMATTING = 0x700000
     # Other
     HR = 0x1000000
+    # The spellcheck language used from this line on (see Highlighter)
+    LANGUAGE = 0x7e000000
+
+
+class TextBlockData(QTextBlockUserData):
+    """Cached data about a text block that follows it when lines move."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        # The block revision and length word_count was calculated for.
+        # Merging two blocks doesn't always bump the revision, but it does
+        # change the length.
+        self.revision = -1
+        self.length = -1
+        self.word_count = 0
+        # How many of the block's words are included in the chapter index
+        self.indexed_word_count = 0
+        # The words the highlighter spellchecked in the block, and which
+        # block number it had back then
+        self.words: Set[str] = set()
+        self.block_number = -1
 
 
 def autocomplete_file_path(name: str, text: str) -> List[str]:
@@ -18,20 +18,22 @@
 import logging
 import re
 import sys
-from typing import Dict, List, cast
+from typing import Dict, List, Optional, Set, Tuple, cast
 
 from libsyntyche.cli import ArgumentRules, AutocompletionPattern, Command
 from libsyntyche.widgets import Signal0, Signal1, Signal3
 from PyQt5 import QtCore, QtGui
 
 from .chapteroverview import ChapterOverview
-from .chapters import ChapterIndex
-from .common import FailSafeBase, KalpanaObject, command_callback
+from .chapters import ChapterIndex, merge_changes
+from .common import (FailSafeBase, KalpanaObject, TextBlockData,
+                     command_callback)
 from .filehandler import FileHandler
 from .highlighter import Highlighter
 from .mainwindow import MainWindow
+from .recovery import RecoveryJournal
 from .settings import Settings
-from .spellcheck import Spellchecker
+from .spellcheck import SpellcheckDictionaries, Spellchecker
 from .terminal import Terminal
 from .textarea import TextArea
 from .vimmode import VimMode
@@ -46,7 +48,8 @@ logger = logging.getLogger(__name__)
 
 
 class Controller(FailSafeBase):
-    def __init__(self, mainwindow: MainWindow, settings: Settings) -> None:
+    def __init__(self, mainwindow: MainWindow, settings: Settings,
+                 dictionaries: SpellcheckDictionaries) -> None:
         # Objects created in the application constructor
         self.settings = settings
         self.mainwindow = mainwindow
@@ -65,16 +68,41 @@ class Controller(FailSafeBase):
                                self.textarea.visible_blocks,
                                activate_insert_mode)
         self.textarea.normal_mode_key_event = self.vimmode.key_pressed
-        self.chapter_overview = ChapterOverview(self.mainwindow)
+        self.chapter_index = ChapterIndex()
+        self.chapter_overview = ChapterOverview(self.mainwindow,
+                                                self.chapter_index)
         self.terminal = Terminal(self.mainwindow, self.settings.command_history)
         self.filehandler = FileHandler(self.textarea.toPlainText,
-                                       self.textarea.document().isModified)
-        self.chapter_index = ChapterIndex()
-        self.spellchecker = Spellchecker(self.settings.config_dir,
-                                         self.textarea.word_under_cursor)
+                                       self.textarea.document().isModified,
+                                       self.textarea.document().revision)
+        self.recovery_journal = RecoveryJournal(self.settings.config_dir,
+                                                self.textarea.document())
+        # Changes to the document are merged and only applied to the
+        # chapter index once per event loop iteration
+        self.pending_index_change: Optional[Tuple[int, int, int]] = None
+        # A file being loaded in chunks is indexed from its whole text
+        # instead, so the document's changes are ignored until it's done
+        self.file_is_loading = False
+        self.chapter_index_timer = QtCore.QTimer()
+        self.chapter_index_timer.setInterval(0)
+        self.chapter_index_timer.setSingleShot(True)
+        self.chapter_index_timer.timeout.connect(self.update_chapter_index)
+        self.spellchecker = Spellchecker(
+            dictionaries,
+            self.textarea.word_under_cursor,
+            lambda: self.highlighter.block_language(self.textarea.textCursor().block()))
+        # Spelling suggestions are made for the misspelled words on screen
+        self.suggestion_prefetch_timer = QtCore.QTimer()
+        self.suggestion_prefetch_timer.setInterval(300)
+        self.suggestion_prefetch_timer.setSingleShot(True)
+        self.suggestion_prefetch_timer.timeout.connect(
+            self.prefetch_spelling_suggestions)
         self.highlighter = Highlighter(self.textarea.document(),
                                        lambda: self.textarea.palette().windowText().color(),
-                                       self.spellchecker.check_word)
+                                       self.spellchecker.check_word,
+                                       self.spellchecker.language_exists,
+                                       self.textarea.visible_blocks)
+        self.textarea.get_hr_blocks = lambda: self.highlighter.hr_blocks
         # Init mainwindow with the objects it needs
         self.mainwindow.set_terminal(self.terminal)
         self.mainwindow.add_stack_widgets([self.textarea, self.chapter_overview])
@@ -87,6 +115,16 @@ class Controller(FailSafeBase):
         """Called by the main application when its constructor is finished"""
         self.highlighter.init_done()
 
+    def close(self) -> None:
+        """Stop everything that could still use the window once it's closed."""
+        self.chapter_index_timer.stop()
+        self.suggestion_prefetch_timer.stop()
+        self.filehandler.load_timer.stop()
+        self.spellchecker.close()
+        self.chapter_index.close()
+        self.filehandler.close()
+        self.recovery_journal.close()
+
     def error(self, text: str) -> None:
         self.terminal.error(text)
 
@@ -136,8 +174,13 @@ class Controller(FailSafeBase):
                                   (' modified', 'Print whether the file is '
                                    'modified or not.'),
                                   (' spellcheck', 'Print whether spellcheck '
-                                   'is currently active and with which '
-                                   'language.'))),
+                                   'is currently active, with which '
+                                   'language, and how well its word cache '
+                                   'is doing.'),
+                                  (' painting', 'Print how many frames the '
+                                   'text area has painted, how long it took '
+                                   'and how many times the line numbers '
+                                   'changed its margin.'))),
                 Command('export-chapter', 'Export a chapter',
                         self.export_chapter,
                         args=ArgumentRules.REQUIRED, short_name='e',
@@ -178,7 +221,10 @@ class Controller(FailSafeBase):
         objects: List[KalpanaObject] = [
             self.textarea, self.filehandler, self.spellchecker,
             self.chapter_index, self.settings, self.terminal,
-            self.mainwindow, self.highlighter
+            self.mainwindow, self.highlighter,
+            # This has to come after the textarea, since it checks if the
+            # document is still modified when the file is saved
+            self.recovery_journal,
         ]
         for obj in objects:
             if obj != self.terminal:
@@ -195,16 +241,57 @@ class Controller(FailSafeBase):
                 self.filehandler.file_saved_signal.connect(obj.file_saved)
                 self.filehandler.file_opened_signal.connect(obj.file_opened)
 
+        # Chapter index signals
+        self.chapter_index.chapters_changed.connect(
+            self.chapter_overview.chapters_changed)
+        self.chapter_index.chapters_inserted.connect(
+            self.chapter_overview.chapters_inserted)
+        self.chapter_index.chapters_removed.connect(
+            self.chapter_overview.chapters_removed)
+
         # Filehandler signals
+        # The chapter index of an opened file is made from its text in a
+        # thread, instead of from the document once the text is in it
+        self.filehandler.file_read.connect(
+            self.chapter_index.index_text_in_background)
+
+        def file_opened(filepath: str, is_new: bool) -> None:
+            if not is_new:
+                self.pending_index_change = None
+        self.filehandler.file_opened_signal.connect(file_opened)
+
         def set_text(text: str) -> None:
             self.textarea.setPlainText(text)
             # For some reason, this isn't properly emitted
             cast(Signal1[bool], self.textarea.document().modificationChanged).emit(False)
         self.filehandler.set_text.connect(set_text)
 
+        def append_text(text: str) -> None:
+            document = self.textarea.document()
+            cursor = QtGui.QTextCursor(document)
+            cursor.movePosition(QtGui.QTextCursor.End)
+            # Loading a file shouldn't be something you can undo
+            document.setUndoRedoEnabled(False)
+            cursor.insertText(text)
+            document.setUndoRedoEnabled(True)
+            document.setModified(False)
+        self.filehandler.append_text.connect(append_text)
+
+        def loading_file(loading: bool) -> None:
+            self.textarea.setReadOnly(loading)
+            self.file_is_loading = loading
+            # The index made from the file's text replaces the old one, so
+            # any changes to the old document don't matter anymore
+            self.pending_index_change = None
+            self.chapter_index_timer.stop()
+        self.filehandler.loading_file.connect(loading_file)
+        self.filehandler.document_saved.connect(self.textarea.document_saved)
+
         # Spellchecker signals
         self.spellchecker.rehighlight.connect(self.highlighter.rehighlight)
-        self.spellchecker.rehighlight_word.connect(self.highlighter.rehighlight_word)
+        self.spellchecker.rehighlight_words.connect(self.highlighter.rehighlight_words)
+        self.spellchecker.rehighlight_words.connect(
+            lambda _: self.suggestion_prefetch_timer.start())
 
         # Terminal signals
         self.terminal.show_message.connect(self.mainwindow.message_tray.add_message)
@@ -215,9 +302,18 @@ class Controller(FailSafeBase):
             # QTextDocument's equivalent signal only emits on edit operations,
             # but we want it on any movement at all
             self.highlighter.new_cursor_position(self.textarea.textCursor().block())
+            self.suggestion_prefetch_timer.start()
         cast(Signal0, self.textarea.cursorPositionChanged).connect(new_cursor_position)
+        cast(Signal1[int], self.textarea.verticalScrollBar().valueChanged
+             ).connect(lambda _: self.suggestion_prefetch_timer.start())
         cast(Signal3[int, int, int], self.textarea.document().contentsChange
-             ).connect(self.update_chapter_index)
+             ).connect(self.queue_chapter_index_update)
+        cast(Signal3[int, int, int], self.textarea.document().contentsChange
+             ).connect(self.recovery_journal.contents_changed)
+        self.filehandler.changes_discarded.connect(
+            self.recovery_journal.discard_changes)
+        self.mainwindow.changes_discarded.connect(
+            self.recovery_journal.discard_changes)
         cast(Signal1[bool], self.textarea.modificationChanged
              ).connect(self.mainwindow.modification_changed)
 
@@ -246,26 +342,52 @@ class Controller(FailSafeBase):
         else:
             self.terminal.input_field.setFocus()
 
-    def update_chapter_index(self, pos: int, removed: int, added: int) -> None:
+    def queue_chapter_index_update(self, pos: int, removed: int,
+                                   added: int) -> None:
+        if self.file_is_loading:
+            return
+        if self.pending_index_change is None:
+            self.pending_index_change = (pos, removed, added)
+        else:
+            self.pending_index_change = merge_changes(
+                self.pending_index_change, (pos, removed, added))
+        if not self.chapter_index_timer.isActive():
+            self.chapter_index_timer.start()
+
+    def update_chapter_index(self) -> bool:
+        """
+        Apply any pending document changes to the chapter index.
+
+        This has to be run before using the chapter index for anything.
+        Return False if the index can't be used, since the document only
+        has part of a file that is being loaded.
+        """
+        self.chapter_index_timer.stop()
+        if self.file_is_loading:
+            self.terminal.error('Wait until the file has been loaded')
+            return False
+        self.chapter_index.wait_for_text_index()
+        if self.pending_index_change is None:
+            return True
+        pos, removed, added = self.pending_index_change
+        self.pending_index_change = None
         with self.try_it("chapter index couldn't be updated"):
-            new_index = self.chapter_index.update_line_index(
+            # The overview is updated by the index's change notices
+            self.chapter_index.update_line_index(
                 self.textarea.document(), self.textarea.textCursor(),
                 pos, removed, added)
-            if new_index:
-                self.chapter_overview.load_chapter_data(
-                    self.chapter_index.chapters)
+        return True
 
     # =========== COMMANDS ================================
 
     @command_callback
     def toggle_chapter_overview(self) -> None:
         if self.mainwindow.active_stack_widget == self.textarea:
+            if not self.update_chapter_index():
+                return
+            self.chapter_index.update_word_counts(self.textarea.document())
             if not self.chapter_overview.empty:
-                self.chapter_index.full_line_index_update(
-                    self.textarea.document())
-                self.chapter_overview.load_chapter_data(
-                    self.chapter_index.chapters, update_stylesheet=True,
-                    force_refresh=True)
+                self.chapter_overview.update_state_colors()
                 self.mainwindow.active_stack_widget = self.chapter_overview
             else:
                 self.terminal.error('No chapters to show')
@@ -287,16 +409,48 @@ class Controller(FailSafeBase):
             active = ('Active' if self.spellchecker.spellcheck_active
                       else 'Inactive')
             language = self.spellchecker.language
-            self.terminal.print_(f'{active}, language: {language}')
+            dictionaries = self.spellchecker.dictionaries
+            cached = sum(len(c) for c in dictionaries.word_caches.values())
+            languages = ', '.join(sorted(dictionaries.word_caches))
+            self.terminal.print_(
+                f'{active}, language: {language}, '
+                f'cache: {cached} words in {languages} '
+                f'(max {dictionaries.word_cache_size} per language), '
+                f'{dictionaries.word_cache_hits} hits, '
+                f'{dictionaries.word_cache_misses} misses, '
+                f'{dictionaries.word_cache_evictions} evictions')
+        elif arg == 'painting':
+            frames = self.textarea.frames_painted
+            average = 1000 * self.textarea.paint_time / max(frames, 1)
+            self.terminal.print_(
+                f'{frames} frames painted ({average:.2f} ms on average), '
+                f'{self.textarea.line_number_bar.margin_changes} '
+                f'margin changes')
         else:
             self.terminal.error('Invalid argument')
 
     def get_show_info_suggestions(self, name: str, text: str
                                   ) -> List[str]:
-        return [item for item in ['file', 'spellcheck', 'modified']
+        return [item for item in ['file', 'spellcheck', 'modified', 'painting']
                 if item.startswith(text)]
 
+    def prefetch_spelling_suggestions(self) -> None:
+        if not self.spellchecker.spellcheck_active:
+            return
+        words: Dict[str, Set[str]] = {}
+        blocks = [block for _, block in self.textarea.visible_blocks()]
+        blocks.append(self.textarea.textCursor().block())
+        for block in blocks:
+            data = block.userData()
+            if isinstance(data, TextBlockData):
+                language = self.highlighter.block_language(block)
+                words.setdefault(language, set()).update(data.words)
+        for language, language_words in words.items():
+            self.spellchecker.prefetch_suggestions(language, language_words)
+
     def _go_to_chapter(self, chapter: int) -> None:
+        if not self.update_chapter_index():
+            return
         total_chapters = len(self.chapter_index.chapters)
         if chapter not in range(-total_chapters, total_chapters):
             self.terminal.error('Invalid chapter!')
@@ -316,6 +470,8 @@ class Controller(FailSafeBase):
             means going from the end, where -1 is the last chapter
             and -2 is the second to last.
         """
+        if not self.update_chapter_index():
+            return
         if not self.chapter_index.chapters:
             self.terminal.error('No chapters detected!')
         elif not re.match(r'-?\d+$', arg):
@@ -337,6 +493,8 @@ class Controller(FailSafeBase):
 
         diff - How many chapters to move, negative to move backwards.
         """
+        if not self.update_chapter_index():
+            return
         current_line = self.textarea.textCursor().blockNumber()
         current_chapter = self.chapter_index.which_chapter(current_line)
         target_chapter = max(0, min(len(self.chapter_index.chapters) - 1,
@@ -355,15 +513,23 @@ class Controller(FailSafeBase):
 
     @command_callback
     def count_total_words(self) -> None:
-        words = len(self.textarea.toPlainText().split())
+        if not self.update_chapter_index():
+            return
+        document = self.textarea.document()
+        self.chapter_index.update_word_counts(document)
+        # Unlike the chapter word counts, this includes the chapter lines
+        words = (self.chapter_index.total_word_count
+                 + self.chapter_index.uncounted_word_count(document))
         self.terminal.print_(f'Total words: {words}')
 
     @command_callback
     def count_chapter_words(self, arg: str) -> None:
+        if not self.update_chapter_index():
+            return
         if not self.chapter_index.chapters:
             self.terminal.error('No chapters detected!')
         elif not arg:
-            self.chapter_index.full_line_index_update(self.textarea.document())
+            self.chapter_index.update_word_counts(self.textarea.document())
             current_line = self.textarea.textCursor().blockNumber()
             current_chapter = self.chapter_index.which_chapter(current_line)
             words = self.chapter_index.chapters[current_chapter].word_count
@@ -373,14 +539,15 @@ class Controller(FailSafeBase):
         elif int(arg) >= len(self.chapter_index.chapters):
             self.terminal.error('Invalid chapter!')
         else:
-            # yes this is an ugly hack
-            self.chapter_index.full_line_index_update(self.textarea.document())
+            self.chapter_index.update_word_counts(self.textarea.document())
             words = self.chapter_index.chapters[int(arg)].word_count
             self.terminal.print_(f'Words in chapter {arg}: {words}')
 
     @command_callback
     def export_chapter(self, arg: str) -> None:
         # TODO: unify the whole chapter arg thingy
+        if not self.update_chapter_index():
+            return
         args = arg.split(None, 1)
         if not len(args) == 2:
             self.terminal.error('Specify both chapter and format!')
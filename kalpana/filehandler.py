@@ -15,32 +15,170 @@
 # You should have received a copy of the GNU General Public License
 # along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import os.path
-import subprocess
-import sys
-from typing import Callable, Optional
+import queue
+import shutil
+import tempfile
+import threading
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
 
 from libsyntyche.cli import ArgumentRules, AutocompletionPattern, Command
-from libsyntyche.widgets import mk_signal1, mk_signal2
+from libsyntyche.widgets import mk_signal0, mk_signal1, mk_signal2
 from PyQt5 import QtCore
 
 from .common import KalpanaObject, autocomplete_file_path, command_callback
 
 
+def _default_file_mode() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# The permissions of new files (this has to be checked before any threads
+# are started, since the umask can't be read without changing it)
+DEFAULT_FILE_MODE = _default_file_mode()
+
+
+def write_file_safely(filepath: str, text: str) -> None:
+    """
+    Write the text to the file without ever leaving it half written.
+
+    The text is written to a temporary file in the same directory, which is
+    flushed to the disk and then renamed to replace the original file.
+    """
+    filepath = os.path.realpath(filepath)
+    directory, filename = os.path.split(filepath)
+    fd, temp_path = tempfile.mkstemp(prefix=f'.{filename}.', suffix='.tmp',
+                                     dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, temp_path)
+        else:
+            os.chmod(temp_path, DEFAULT_FILE_MODE)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    # Make sure the rename itself is on the disk too
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def decode_text(data: bytes) -> Tuple[str, str]:
+    """
+    Return the decoded text and its encoding.
+
+    The text is decoded as utf-8 if possible and latin1 (which never fails)
+    otherwise. Newlines are converted like when reading in text mode.
+    """
+    try:
+        text, encoding = data.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        text, encoding = data.decode('latin1'), 'latin1'
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text, encoding
+
+
+def _save_files_in_background(requests: 'queue.Queue[Optional[Tuple[str, str]]]',
+                              file_written: Callable[[str, str], None]
+                              ) -> None:
+    """
+    Write files sent from the GUI thread, in the order they're sent.
+
+    Each request is a tuple of (filepath, text). When a file has been
+    written (or failed to be), file_written is called with the filepath
+    and an error message, which is empty if everything went fine. None
+    stops the thread.
+    """
+    while True:
+        request = requests.get()
+        if request is None:
+            requests.task_done()
+            return
+        filepath, text = request
+        try:
+            write_file_safely(filepath, text)
+        except OSError as e:
+            file_written(filepath, e.strerror or str(e))
+        except Exception as e:
+            file_written(filepath, str(e))
+        else:
+            file_written(filepath, '')
+        finally:
+            requests.task_done()
+
+
 class FileHandler(QtCore.QObject, KalpanaObject):
     """Takes care of saving and opening files."""
+    # How many characters to load at a time when opening big files
+    load_chunk_size = 1000000
     # file_opened(filepath, is new file)
     file_opened_signal = mk_signal2(str, bool)
     # file_saved(filepath, new save name)
     file_saved_signal = mk_signal2(str, bool)
     set_text = mk_signal1(str)
+    # The whole text of a file being opened, before it's in the document
+    file_read = mk_signal1(str)
+    # Big files are added to the (empty) document a chunk at a time
+    append_text = mk_signal1(str)
+    loading_file = mk_signal1(bool)
+    # Open a file (or a new file if it's empty) in a new window
+    new_window_requested = mk_signal1(str)
+    # Emitted when the user chooses to throw away the unsaved changes
+    changes_discarded = mk_signal0()
+    # Emitted before file_saved_signal when the saved text had every
+    # change made to the document so far
+    document_saved = mk_signal0()
+    # file_written(filepath, error message), emitted from the save thread
+    file_written = mk_signal2(str, str)
 
     def __init__(self, get_text: Callable[[], str],
-                 is_modified: Callable[[], bool]) -> None:
+                 is_modified: Callable[[], bool],
+                 get_revision: Callable[[], int]) -> None:
         super().__init__()
         self.is_modified = is_modified
         self.get_text = get_text
+        self.get_revision = get_revision
         self.filepath: Optional[str] = None
+        # The file currently being loaded in chunks
+        self.loading_filepath: Optional[str] = None
+        self.loading_encoding = ''
+        self.loading_text = ''
+        self.loading_pos = 0
+        self.load_timer = QtCore.QTimer(self)
+        self.load_timer.setInterval(0)
+        self.load_timer.timeout.connect(self.load_next_chunk)
+        # Files are written in a background thread. The pending saves are
+        # the filepaths, whether they're new save names and the document
+        # revisions that are saved, oldest first.
+        self.pending_saves: Deque[Tuple[str, bool, int]] = deque()
+        self.file_written.connect(self._file_written)
+        self.save_requests: 'queue.Queue[Optional[Tuple[str, str]]]' = \
+            queue.Queue()
+        self.save_thread = threading.Thread(
+            target=_save_files_in_background,
+            args=(self.save_requests, self.file_written.emit),
+            daemon=True)
+        self.save_thread.start()
         self.kalpana_commands = [
                 Command('new-file', 'Create a new file.',
                         self.new_file,
@@ -117,6 +255,7 @@ class FileHandler(QtCore.QObject, KalpanaObject):
             self.new_file(filepath)
 
     def force_new_file(self, filepath: str) -> None:
+        self.changes_discarded.emit()
         self.new_file(filepath, force=True)
 
     @command_callback
@@ -131,7 +270,9 @@ class FileHandler(QtCore.QObject, KalpanaObject):
         Note that nothing is written to the disk when new_file is run. An
         invalid filepath will only be detected when trying to save.
         """
-        if self.is_modified() and not force:
+        if self.loading_filepath is not None:
+            self.error('Wait until the file has been loaded')
+        elif self.is_modified() and not force:
             self.confirm('There are unsaved changes. Discard them?',
                          self.force_new_file, filepath or '')
         elif filepath and os.path.exists(filepath):
@@ -149,14 +290,14 @@ class FileHandler(QtCore.QObject, KalpanaObject):
 
     @command_callback
     def new_file_in_new_window(self, filepath: Optional[str]) -> None:
-        """Open a new file in a new instance of Kalpana."""
+        """Open a new file in a new window."""
         if filepath and os.path.exists(filepath):
             self.error('File already exists, open it instead')
         else:
-            subprocess.Popen([sys.executable, sys.argv[0]] +
-                             ([filepath] if filepath else []))
+            self.new_window_requested.emit(filepath or '')
 
     def force_open_file(self, filepath: str) -> None:
+        self.changes_discarded.emit()
         self.open_file(filepath, force=True)
 
     @command_callback
@@ -164,37 +305,69 @@ class FileHandler(QtCore.QObject, KalpanaObject):
         """
         Open a file, unless there are unsaved changes.
 
-        This will only open files encoded in utf-8 or latin1.
+        This will only open files encoded in utf-8 or latin1. Big files are
+        loaded a chunk at a time, and the file is opened when they're done.
         """
-        if self.is_modified() and not force:
+        if self.loading_filepath is not None:
+            self.error('Wait until the file has been loaded')
+        elif self.is_modified() and not force:
             self.confirm('There are unsaved changes. Discard them?',
                          self.force_open_file, filepath)
         elif not os.path.isfile(filepath):
             self.error('The path is not a file')
         else:
-            encodings = ['utf-8', 'latin1']
-            for e in encodings:
-                try:
-                    with open(filepath, encoding=e) as f:
-                        text = f.read()
-                except UnicodeDecodeError:
-                    continue
-                else:
-                    self.set_text.emit(text)
-                    self.filepath = filepath
-                    self.log(f'File opened: {filepath}')
-                    self.file_opened_signal.emit(filepath, False)
-                    return
-            else:
+            try:
+                with open(filepath, 'rb') as f:
+                    data = f.read()
+            except IOError:
                 self.error(f'Unable to open the file: {filepath}')
+                return
+            text, encoding = decode_text(data)
+            self.file_read.emit(text)
+            if len(text) <= self.load_chunk_size:
+                self.set_text.emit(text)
+                self._file_loaded(filepath, encoding)
+            else:
+                self.loading_filepath = filepath
+                self.loading_encoding = encoding
+                self.loading_text = text
+                self.loading_pos = 0
+                self.loading_file.emit(True)
+                self.set_text.emit('')
+                self.load_timer.start()
+
+    def load_next_chunk(self) -> None:
+        """Add the next chunk of the file being loaded to the document."""
+        assert self.loading_filepath is not None
+        text = self.loading_text
+        start = self.loading_pos
+        # End the chunks on a line break if possible
+        end = text.find('\n', start + self.load_chunk_size) + 1 or len(text)
+        self.append_text.emit(text[start:end])
+        self.loading_pos = end
+        if end < len(text):
+            self.log(f'Loading {self.loading_filepath}: '
+                     f'{end * 100 // len(text)}%')
+            return
+        self.load_timer.stop()
+        filepath = self.loading_filepath
+        self.loading_filepath = None
+        self.loading_text = ''
+        self.loading_file.emit(False)
+        self._file_loaded(filepath, self.loading_encoding)
+
+    def _file_loaded(self, filepath: str, encoding: str) -> None:
+        self.filepath = filepath
+        self.log(f'File opened: {filepath} ({encoding})')
+        self.file_opened_signal.emit(filepath, False)
 
     @command_callback
     def open_file_in_new_window(self, filepath: str) -> None:
-        """Open an existing file in a new instance of Kalpana."""
+        """Open an existing file in a new window."""
         if not filepath:
             self.error('No file specified')
         else:
-            subprocess.Popen([sys.executable, sys.argv[0], filepath])
+            self.new_window_requested.emit(filepath)
 
     def force_save_file(self, filepath: str) -> None:
         self.save_file(filepath, force=True)
@@ -209,29 +382,56 @@ class FileHandler(QtCore.QObject, KalpanaObject):
         prompting.
 
         Note that this always saves in utf-8, no matter the original encoding.
+
+        The file is written in the background and file_saved_signal is
+        emitted when it's done.
         """
-        if not filepath and not self.filepath:
+        if self.loading_filepath is not None:
+            self.error('Wait until the file has been loaded')
+        elif not filepath and not self.filepath:
             self.error('No active file')
         elif filepath and filepath != self.filepath \
                 and os.path.exists(filepath) and not force:
             self.confirm('File already exists. Overwrite?',
                          self.force_save_file, filepath)
         else:
-            if self.filepath is None:
+            # The last pending save is where the file is going to end up
+            current_filepath = (self.pending_saves[-1][0] if self.pending_saves
+                                else self.filepath)
+            if current_filepath is None:
                 file_to_save = filepath
             elif filepath:
                 file_to_save = filepath
             else:
-                file_to_save = self.filepath
+                file_to_save = current_filepath
             # When we get here, either filepath or self.filepath has
             # a valid value (see the first part of this if statement)
             assert file_to_save is not None
-            try:
-                with open(file_to_save, 'w', encoding='utf-8') as f:
-                    f.write(self.get_text())
-            except IOError:
-                self.error(f'Unable to save the file: {file_to_save}')
-            else:
-                self.log(f'File saved: {file_to_save}')
-                self.file_saved_signal.emit(file_to_save, file_to_save != self.filepath)
-                self.filepath = file_to_save
+            self.pending_saves.append((file_to_save,
+                                       file_to_save != current_filepath,
+                                       self.get_revision()))
+            self.save_requests.put((file_to_save, self.get_text()))
+
+    def _file_written(self, filepath: str, error: str) -> None:
+        file_to_save, new_name, revision = self.pending_saves.popleft()
+        if error:
+            self.error(f'Unable to save the file: {file_to_save} ({error})')
+        else:
+            self.log(f'File saved: {file_to_save}')
+            # Anything written during the save (or saved by a later save
+            # that hasn't finished yet) still isn't saved
+            if revision == self.get_revision():
+                self.document_saved.emit()
+            self.file_saved_signal.emit(file_to_save, new_name)
+            self.filepath = file_to_save
+
+    def close(self) -> None:
+        """Stop the background thread once the pending saves are written."""
+        self.save_requests.put(None)
+        self.save_thread.join()
+
+    def wait_for_saves(self) -> None:
+        """Block until all pending saves have been written to the disk."""
+        self.save_requests.join()
+        # Handle the finished saves now instead of in the event loop
+        QtCore.QCoreApplication.sendPostedEvents(None, QtCore.QEvent.MetaCall)
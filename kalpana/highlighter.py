@@ -16,20 +16,53 @@
 # along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
 
 import re
-from itertools import chain
-from typing import Any, Callable
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
-from PyQt5 import QtCore, QtGui
+from PyQt5 import QtCore, QtGui, sip
 
-from .common import KalpanaObject
+from .common import KalpanaObject, TextBlockData
 from .common import TextBlockState as TBS
 
+# How far the language index is shifted in a block's state
+LANGUAGE_SHIFT = 25
+
+
+class UTF16Positions:
+    """
+    Translate positions in a string to positions in Qt's UTF-16 text.
+
+    Characters outside the BMP take up two positions in UTF-16, so every
+    position after one of them is shifted. The text is only scanned once,
+    and if it doesn't contain any such characters (which is the common
+    case) positions are returned as they are.
+    """
+    astral_rx = re.compile(r'[\U00010000-\U0010ffff]')
+
+    def __init__(self, text: str) -> None:
+        self.astral_chars = [m.start() for m in self.astral_rx.finditer(text)]
+        self.length = self.pos(len(text))
+
+    def pos(self, index: int) -> int:
+        """Return the UTF-16 position of an index in the string."""
+        if not self.astral_chars:
+            return index
+        return index + bisect_left(self.astral_chars, index)
+
 
 class Highlighter(QtGui.QSyntaxHighlighter, KalpanaObject):
 
+    # How long (in seconds) to rehighlight each time the event loop is idle
+    rehighlight_time_slice = 0.02
+
     def __init__(self, document: QtGui.QTextDocument,
                  get_fg: Callable[[], QtGui.QColor],
-                 check_word: Callable[[str], bool]) -> None:
+                 check_word: Callable[[str, str], Optional[bool]],
+                 language_exists: Callable[[str], bool],
+                 get_visible_blocks: Callable[[], Iterable[Tuple[QtCore.QRectF,
+                                                                 QtGui.QTextBlock]]]
+                 ) -> None:
         super().__init__(document)
         self.kalpana_settings = [
             'italic-marker',
@@ -44,11 +77,34 @@ class Highlighter(QtGui.QSyntaxHighlighter, KalpanaObject):
         self.hr_marker = '*'
         self.get_fg = get_fg
         self.check_word = check_word
+        self.language_exists = language_exists
         self.chapter_keyword = ''
         self.spellcheck_active = False
         self.active_block = document.firstBlock()
         self.last_block = self.active_block
         self.init_is_done = False
+        self.update_marker_regex()
+        self.get_visible_blocks = get_visible_blocks
+        # Progressive rehighlighting. Cursors keep their place in the text
+        # when it's edited between the chunks, unlike block numbers.
+        self.rehighlight_cursor = QtGui.QTextCursor(document)
+        self.visible_rehighlighted_blocks: Optional[
+            Tuple[QtGui.QTextCursor, QtGui.QTextCursor]] = None
+        self.rehighlight_timer = QtCore.QTimer(self)
+        self.rehighlight_timer.setInterval(0)
+        self.rehighlight_timer.timeout.connect(self.rehighlight_chunk)
+        # The data of all blocks each spellchecked word is in
+        self.word_index: Dict[str, Set[TextBlockData]] = {}
+        # The spellcheck languages set in the text. A block's state includes
+        # the index of its language, where 0 is the default language.
+        # Unused indexes are empty strings and can be given to new languages.
+        self.languages = ['']
+        self.reported_languages: Set[str] = set()
+        # The numbers of all blocks that are horizontal rulers. The numbers
+        # are shifted when blocks are added or removed, which is noticed the
+        # next time a block is highlighted (always the first changed block).
+        self.hr_blocks: Set[int] = set()
+        self.hr_block_count = document.blockCount()
 
     def init_done(self) -> None:
         # This is here to avoid a gazillion different rehighlight() calls
@@ -57,16 +113,65 @@ class Highlighter(QtGui.QSyntaxHighlighter, KalpanaObject):
         self.rehighlight()
 
     def rehighlight(self) -> None:
-        if self.init_is_done:
-            super().rehighlight()
+        """
+        Rehighlight the whole document without freezing the window.
+
+        The visible blocks are rehighlighted right away and the rest of the
+        document is done in small chunks whenever the event loop is idle.
+        Calling this again before it's done starts it over.
+        """
+        if not self.init_is_done:
+            return
+        visible_blocks = [block for _, block in self.get_visible_blocks()]
+        for block in visible_blocks:
+            self.rehighlightBlock(block)
+        if visible_blocks:
+            self.visible_rehighlighted_blocks = (
+                QtGui.QTextCursor(visible_blocks[0]),
+                QtGui.QTextCursor(visible_blocks[-1]))
+        else:
+            self.visible_rehighlighted_blocks = None
+        self.rehighlight_cursor.setPosition(0)
+        self.rehighlight_timer.start()
+
+    def cancel_rehighlight(self) -> None:
+        """Stop any unfinished rehighlighting."""
+        self.rehighlight_timer.stop()
+
+    def rehighlight_chunk(self) -> None:
+        """Rehighlight blocks until the time slice is used up."""
+        deadline = time.perf_counter() + self.rehighlight_time_slice
+        block = self.rehighlight_cursor.block()
+        visible_blocks = self.visible_rehighlighted_blocks
+        while block.isValid():
+            if visible_blocks is not None \
+                    and visible_blocks[0].block().position() <= block.position() \
+                    <= visible_blocks[1].block().position():
+                block = visible_blocks[1].block().next()
+                continue
+            self.rehighlightBlock(block)
+            block = block.next()
+            if time.perf_counter() > deadline:
+                break
+        if block.isValid():
+            self.rehighlight_cursor.setPosition(block.position())
+        else:
+            self.rehighlight_timer.stop()
+
+    def file_opened(self, filepath: str, is_new: bool) -> None:
+        # Setting the text highlights the whole document anyway
+        self.cancel_rehighlight()
 
     def setting_changed(self, name: str, new_value: Any) -> None:
         if name == 'italic-marker':
             self.italic_marker = str(new_value)
+            self.update_marker_regex()
         elif name == 'bold-marker':
             self.bold_marker = str(new_value)
+            self.update_marker_regex()
         elif name == 'underline-marker':
             self.underline_marker = str(new_value)
+            self.update_marker_regex()
         elif name == 'horizontal-ruler-marker':
             self.hr_marker = str(new_value)
         elif name == 'spellcheck-active':
@@ -88,24 +193,176 @@ class Highlighter(QtGui.QSyntaxHighlighter, KalpanaObject):
                     self.document().markContentsDirty(block.position(),
                                                       block.length())
 
-    def rehighlight_word(self, word: str) -> None:
+    def rehighlight_words(self, words: List[str]) -> None:
+        """Rehighlight all blocks where the words have been spellchecked."""
+        blocks: Set[TextBlockData] = set()
+        for word in words:
+            indexed_blocks = self.word_index.get(word)
+            if indexed_blocks is None:
+                continue
+            for data in list(indexed_blocks):
+                if sip.isdeleted(data):
+                    # The block has been removed
+                    indexed_blocks.discard(data)
+                else:
+                    blocks.add(data)
+            if not indexed_blocks:
+                del self.word_index[word]
+        moved_blocks: Set[TextBlockData] = set()
+        for data in blocks:
+            block = self.document().findBlockByNumber(data.block_number)
+            if block.userData() is data:
+                self.rehighlightBlock(block)
+            else:
+                moved_blocks.add(data)
+        # Lines have been added or removed since the blocks were indexed
+        if moved_blocks:
+            block = self.document().firstBlock()
+            while block.isValid() and moved_blocks:
+                block_data = block.userData()
+                if block_data in moved_blocks:
+                    moved_blocks.discard(block_data)
+                    self.rehighlightBlock(block)
+                block = block.next()
+
+    def update_word_index(self, words: Set[str]) -> None:
+        """Update which words the current block contains."""
+        data = self.currentBlockUserData()
+        if not isinstance(data, TextBlockData):
+            data = TextBlockData()
+            self.setCurrentBlockUserData(data)
+        for word in data.words - words:
+            indexed_blocks = self.word_index.get(word)
+            if indexed_blocks is not None:
+                indexed_blocks.discard(data)
+                if not indexed_blocks:
+                    del self.word_index[word]
+        for word in words - data.words:
+            self.word_index.setdefault(word, set()).add(data)
+        data.words = words
+        data.block_number = self.currentBlock().blockNumber()
+
+    def language_state(self, language: str) -> int:
+        """Return the block state bits for a spellcheck language."""
+        if language and language in self.languages:
+            return self.languages.index(language) << LANGUAGE_SHIFT
+        # Only installed languages get an index, otherwise every half-typed
+        # language name would use one up
+        if not language or not self.language_exists(language):
+            return 0
+        if '' not in self.languages[1:] \
+                and len(self.languages) > TBS.LANGUAGE >> LANGUAGE_SHIFT:
+            self.free_unused_languages()
+        if '' in self.languages[1:]:
+            index = self.languages.index('', 1)
+            self.languages[index] = language
+        elif len(self.languages) > TBS.LANGUAGE >> LANGUAGE_SHIFT:
+            if language not in self.reported_languages:
+                self.reported_languages.add(language)
+                self.error(f'Too many spellcheck languages, '
+                           f'using the default language instead of {language}')
+            return 0
+        else:
+            index = len(self.languages)
+            self.languages.append(language)
+        return index << LANGUAGE_SHIFT
+
+    def free_unused_languages(self) -> None:
+        """Free the indexes of the languages no block uses anymore."""
+        used_indexes = {0}
         block = self.document().firstBlock()
         while block.isValid():
-            if word in block.text():
-                self.rehighlightBlock(block)
+            # Blocks that haven't been highlighted yet have no language
+            if block.userState() >= 0:
+                used_indexes.add((block.userState() & TBS.LANGUAGE) >> LANGUAGE_SHIFT)
             block = block.next()
+        self.languages = [language if index in used_indexes else ''
+                          for index, language in enumerate(self.languages)]
+
+    def block_language(self, block: QtGui.QTextBlock) -> str:
+        """Return a block's spellcheck language, or '' for the default."""
+        state = block.userState()
+        if state < 0:
+            return ''
+        return self.languages[(state & TBS.LANGUAGE) >> LANGUAGE_SHIFT]
 
     @staticmethod
-    def utf16_len(text: str) -> int:
-        """Adjust for the UTF-16 backend Qt uses."""
-        return len(re.sub(r'[\uffff-\U0010ffff]', 'xx', text))
+    def get_line_language(text: str, line_state: int) -> Optional[str]:
+        """
+        Return the spellcheck language set by a line, if any.
+
+        The language is set with a "lang:" tag in a chapter's tags line
+        (eg. "#lang:sv_SE") or with a meta line (eg. "%% lang: sv_SE") and
+        lasts until the end of the chapter. An empty language switches back
+        to the default language.
+        """
+        if line_state & TBS.TAGS:
+            for tag in text.split(','):
+                tag = tag.strip()[1:]
+                if tag.startswith('lang:'):
+                    return tag[5:].strip()
+        elif line_state & TBS.META:
+            meta = text[2:].strip()
+            if meta.startswith('lang:'):
+                return meta[5:].strip()
+        return None
+
+    def update_marker_regex(self) -> None:
+        """Compile the regex that finds all formatting markers."""
+        self.markers = sorted({self.italic_marker, self.bold_marker,
+                               self.underline_marker} - {''})
+        if self.markers:
+            self.marker_rx = re.compile('|'.join(
+                re.escape(m) for m in sorted(self.markers, key=len,
+                                             reverse=True)))
+        else:
+            # Never matches anything
+            self.marker_rx = re.compile(r'(?!)')
+
+    def find_markers(self, text: str) -> List[Tuple[int, str]]:
+        """
+        Return the position and marker of all formatting markers in text.
+
+        A marker only counts if it's at the edge of a word, meaning the
+        character before it or (if not) the character after it is neither a
+        word character nor part of the marker. If the character after it is
+        what made a marker count, that character can't make the next
+        instance of the same marker count.
+        """
+        def is_edge(char: str, marker: str) -> bool:
+            return not (char.isalnum() or char == '_' or char in marker)
+        hits: List[Tuple[int, str]] = []
+        # Where the previous hit of each marker ended
+        hit_ends: Dict[str, int] = {}
+        for match in self.marker_rx.finditer(text):
+            pos = match.start()
+            for marker in self.markers:
+                end = pos + len(marker)
+                if not text.startswith(marker, pos) \
+                        or pos < hit_ends.get(marker, 0):
+                    continue
+                if pos == 0 or (pos - 1 >= hit_ends.get(marker, 0)
+                                and is_edge(text[pos-1], marker)):
+                    hits.append((pos, marker))
+                    hit_ends[marker] = end
+                elif end == len(text):
+                    hits.append((pos, marker))
+                    hit_ends[marker] = end
+                elif is_edge(text[end], marker):
+                    hits.append((pos, marker))
+                    hit_ends[marker] = end + 1
+        return hits
 
     @staticmethod
     def get_line_format(text: str, chapter_keyword: str,
                         prev_state: int) -> int:
         prefix = text.startswith
         suffix = text.rstrip().endswith
-        if text.strip() and text.split()[0] == chapter_keyword:
+        # Avoid splitting the whole line just to check the first word
+        stripped = text.lstrip()
+        keyword_end = len(chapter_keyword)
+        if chapter_keyword and stripped.startswith(chapter_keyword) \
+                and not stripped[keyword_end:keyword_end+1].strip():
             return TBS.CHAPTER
         elif prefix('<<') and suffix('>>'):
             return TBS.SECTION
@@ -124,7 +381,28 @@ class Highlighter(QtGui.QSyntaxHighlighter, KalpanaObject):
         # Keep only formatting if not in a chapter line
         return prev_state & TBS.FORMATTING
 
+    def update_hr_block_numbers(self, block_number: int) -> None:
+        """Shift the horizontal rulers after blocks were added or removed."""
+        diff = self.document().blockCount() - self.hr_block_count
+        if not diff:
+            return
+        self.hr_block_count += diff
+        # Blocks after the changed one are the ones added or removed
+        removed = range(block_number + 1, block_number + 1 - diff)
+        self.hr_blocks = {n + diff if n > block_number else n
+                          for n in self.hr_blocks if n not in removed}
+
     def highlightBlock(self, text: str) -> None:
+        block_number = self.currentBlock().blockNumber()
+        self.update_hr_block_numbers(block_number)
+        self._highlight_block(text)
+        if self.currentBlockState() >= 0 \
+                and self.currentBlockState() & TBS.HR:
+            self.hr_blocks.add(block_number)
+        else:
+            self.hr_blocks.discard(block_number)
+
+    def _highlight_block(self, text: str) -> None:
         with self.try_it(f"Highlighting this block ({text!r}) failed"):
             prev_state = self.previousBlockState()
             # Default state is -1 which is Not Good
@@ -132,34 +410,56 @@ class Highlighter(QtGui.QSyntaxHighlighter, KalpanaObject):
                 prev_state = 0
             new_state = self.get_line_format(
                 text, self.chapter_keyword, prev_state)
-            fg = self.get_fg()
-            # Chapter/meta lines
             line_state = new_state & TBS.LINEFORMATS
+            # The spellcheck language is reset with every new chapter
+            if line_state & TBS.CHAPTER:
+                language_state = 0
+            else:
+                language_state = prev_state & TBS.LANGUAGE
+            if line_state & (TBS.TAGS | TBS.META):
+                language = self.get_line_language(text, line_state)
+                if language is not None:
+                    language_state = self.language_state(language)
+            new_state |= language_state
+            # Chapter/meta lines
             if line_state:
-                self.highlight_lines(text, line_state, fg)
-                self.setCurrentBlockState(line_state)
+                self.highlight_lines(UTF16Positions(text), line_state,
+                                     self.get_fg())
+                self.setCurrentBlockState(line_state | language_state)
                 return
             # Horizontal ruler
             if self.hr_marker in text \
                     and text.strip(f' \t{self.hr_marker}') == '':
-                self.highlight_horizontal_ruler(text, fg)
+                self.highlight_horizontal_ruler(UTF16Positions(text),
+                                                self.get_fg())
                 self.setCurrentBlockState(new_state | TBS.HR)
                 return
-            new_state = self.highlight_text_formatting(text, fg, new_state)
+            # Most blocks are plain prose with nothing to format
+            needs_formatting = (new_state & TBS.FORMATTING
+                                or self.marker_rx.search(text) is not None)
+            if not needs_formatting and not self.spellcheck_active:
+                self.setCurrentBlockState(new_state)
+                return
+            positions = UTF16Positions(text)
+            if needs_formatting:
+                new_state = self.highlight_text_formatting(
+                    text, positions, self.get_fg(), new_state)
             self.setCurrentBlockState(new_state)
             if self.spellcheck_active:
-                self.highlight_spelling(text)
+                language = self.languages[language_state >> LANGUAGE_SHIFT]
+                self.highlight_spelling(text, positions, language)
 
-    def highlight_horizontal_ruler(self, text: str, fg: QtGui.QColor) -> None:
+    def highlight_horizontal_ruler(self, positions: UTF16Positions,
+                                   fg: QtGui.QColor) -> None:
         """Hide the asterisks where the horizontal ruler should be."""
         f = QtGui.QTextCharFormat()
         f.setFontPointSize(40)
         if not self.active_block or self.currentBlock() != self.active_block:
             fg.setAlphaF(0)
             f.setForeground(QtGui.QBrush(fg))
-        self.setFormat(0, self.utf16_len(text), f)
+        self.setFormat(0, positions.length, f)
 
-    def highlight_lines(self, text: str, state: int,
+    def highlight_lines(self, positions: UTF16Positions, state: int,
                         fg: QtGui.QColor) -> None:
         """Apply formatting to metadata lines (chapter headers, etc)."""
         f = QtGui.QTextCharFormat()
@@ -184,10 +484,10 @@ class Highlighter(QtGui.QSyntaxHighlighter, KalpanaObject):
             f.setFontPointSize(16)
             f.setFontWeight(QtGui.QFont.Bold)
         f.setForeground(QtGui.QBrush(fg))
-        self.setFormat(0, self.utf16_len(text), f)
+        self.setFormat(0, positions.length, f)
 
-    def highlight_text_formatting(self, text: str, fg: QtGui.QColor,
-                                  state: int) -> int:
+    def highlight_text_formatting(self, text: str, positions: UTF16Positions,
+                                  fg: QtGui.QColor, state: int) -> int:
         """Apply rich text formatting, such as bold or italic text."""
         faded = QtGui.QTextCharFormat()
         fg.setAlphaF(0.5)
@@ -220,23 +520,19 @@ class Highlighter(QtGui.QSyntaxHighlighter, KalpanaObject):
             f.setFontUnderline(True)
         if state & TBS.BOLD:
             f.setFontWeight(QtGui.QFont.Bold)
-        # Get all hits from all markers and sort by position
-        markers = [self.italic_marker, self.bold_marker, self.underline_marker]
-        rx = r'([^\w{0}]|^)?({0})(?(1)|([^\w{0}]|$))'
-        hits = sorted((m.start(2), m.group(2)) for m in
-                      chain(*(re.finditer(rx.format(re.escape(marker)),
-                                          text) for marker in markers)))
+        hits = self.find_markers(text)
         # Find each marker and set + update the format
         last_pos = 0
-        for pos, marker in hits + [(self.utf16_len(text), '')]:
+        for pos, marker in hits + [(len(text), '')]:
             # Only apply the format if it isn't plain or the text is empty
             if not is_clean(f):
-                span = self.utf16_len(text[last_pos:pos])
+                start = positions.pos(last_pos)
+                span = positions.pos(pos) - start
                 if span:
-                    self.setFormat(last_pos, span, f)
+                    self.setFormat(start, span, f)
             # Update the format and fade the marker slightly
             if marker:
-                self.setFormat(pos, 1, faded)
+                self.setFormat(positions.pos(pos), 1, faded)
                 update_format(f, marker)
                 pos += 1
             last_pos = pos
@@ -250,16 +546,21 @@ class Highlighter(QtGui.QSyntaxHighlighter, KalpanaObject):
             new_state |= TBS.BOLD
         return (state & ~TBS.FORMATTING) | new_state
 
-    def highlight_spelling(self, text: str) -> None:
+    def highlight_spelling(self, text: str, positions: UTF16Positions,
+                           language: str) -> None:
         """Highlight misspelled words."""
+        words: Set[str] = set()
         for chunk in re.finditer(r"[\w-]+(?:'\w+)?", text):
             # Skip chunks only consisting of dashes
             if chunk and chunk.group().strip('-'):
                 word = chunk.group()
                 if word.endswith("'s"):
                     word = word[:-2]
-                if not self.check_word(word):
-                    f = self.format(self.utf16_len(text[:chunk.start()]))
+                words.add(word)
+                if self.check_word(word, language) is False:
+                    start = positions.pos(chunk.start())
+                    f = self.format(start)
                     f.setUnderlineColor(QtCore.Qt.red)
                     f.setUnderlineStyle(QtGui.QTextCharFormat.WaveUnderline)
-                    self.setFormat(chunk.start(), chunk.end()-chunk.start(), f)
+                    self.setFormat(start, positions.pos(chunk.end()) - start, f)
+        self.update_word_index(words)
@@ -16,15 +16,48 @@
 # You should have received a copy of the GNU General Public License
 # along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
 
+import getpass
+import hashlib
+import json
 import logging
+import os
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
-from PyQt5 import QtCore, QtWidgets
+from PyQt5 import QtCore, QtNetwork, QtWidgets
 
 from .controller import Controller
 from .mainwindow import MainWindow
-from .settings import Settings
+from .settings import CommandHistory, ConfigFiles, Settings, default_config_dir
+from .spellcheck import SpellcheckDictionaries
+
+logger = logging.getLogger(__name__)
+
+
+def server_name(config_dir: Path) -> str:
+    """Return the name of the local socket of the Kalpana using config_dir."""
+    path_hash = hashlib.sha1(str(config_dir.resolve()).encode('utf-8'))
+    return f'kalpana2-{getpass.getuser()}-{path_hash.hexdigest()[:16]}'
+
+
+def send_files_to_running_instance(name: str, files: List[str]) -> bool:
+    """
+    Ask an already running Kalpana to open the files in new windows.
+
+    An empty list opens one new window without a file. Return False if
+    there is no Kalpana listening.
+    """
+    socket = QtNetwork.QLocalSocket()
+    socket.connectToServer(name)
+    if not socket.waitForConnected(1000):
+        return False
+    data = json.dumps([os.path.abspath(f) for f in files])
+    socket.write(data.encode('utf-8'))
+    socket.waitForBytesWritten(1000)
+    socket.disconnectFromServer()
+    if socket.state() != QtNetwork.QLocalSocket.UnconnectedState:
+        socket.waitForDisconnected(1000)
+    return True
 
 
 class Kalpana(QtWidgets.QApplication):
@@ -33,31 +66,115 @@ class Kalpana(QtWidgets.QApplication):
                  silent_mode: bool = False,
                  file_to_open: Optional[str] = None) -> None:
         super().__init__(['kalpana2'])
-        self.settings = Settings(Path(config_dir) if config_dir else None)
-        self.mainwindow = MainWindow()
-        self.controller = Controller(self.mainwindow, self.settings)
-        self.make_event_filter()
-        self.settings.css_changed.connect(self.setStyleSheet)
-        self.settings.reload_settings()
-        self.settings.reload_stylesheet()
+        self.config_dir = Path(config_dir) if config_dir else default_config_dir()
+        self.config_dir.mkdir(parents=True, exist_ok=True)
+        # These are shared by all windows
+        self.command_history = CommandHistory(self.config_dir)
+        self.config_files = ConfigFiles()
+        self.dictionaries = SpellcheckDictionaries(self.config_dir)
+        self.windows: List[Controller] = []
+        # Other Kalpanas send their files here instead of opening them
+        self.server = QtNetwork.QLocalServer(self)
+        # Only the same user is allowed to open files in this instance
+        self.server.setSocketOptions(QtNetwork.QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self.receive_files)
+        self.open_window(file_to_open)
+
+    def listen(self) -> None:
+        """Start accepting files from other Kalpanas."""
+        name = server_name(self.config_dir)
+        # Listening replaces the socket of any other Kalpana, so make sure
+        # there isn't one still using it
+        socket = QtNetwork.QLocalSocket()
+        socket.connectToServer(name)
+        if socket.waitForConnected(1000):
+            socket.disconnectFromServer()
+            logger.warning('Another Kalpana is already listening for '
+                           'other instances')
+            return
+        # error is also the name of a signal, which confuses mypy
+        error = socket.error()  # type: ignore
+        if error == QtNetwork.QLocalSocket.ConnectionRefusedError:
+            # The socket is left over from a Kalpana that crashed
+            QtNetwork.QLocalServer.removeServer(name)
+        elif error != QtNetwork.QLocalSocket.ServerNotFoundError:
+            logger.warning(f'Unable to listen for other instances: '
+                           f'{socket.errorString()}')
+            return
+        if not self.server.listen(name):
+            logger.warning(f'Unable to listen for other instances: '
+                           f'{self.server.errorString()}')
+
+    def receive_files(self) -> None:
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            data = bytearray()
+
+            def read(socket: QtNetwork.QLocalSocket = socket,
+                     data: bytearray = data) -> None:
+                data.extend(bytes(socket.readAll()))
+
+            def open_files(socket: QtNetwork.QLocalSocket = socket,
+                           data: bytearray = data) -> None:
+                read(socket, data)
+                socket.deleteLater()
+                # Another Kalpana checking if this one is running
+                if not data:
+                    return
+                try:
+                    files = json.loads(data.decode('utf-8'))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    logger.warning('Got invalid data from another instance')
+                    return
+                for filepath in files or ['']:
+                    self.open_window(str(filepath))
+            socket.readyRead.connect(read)
+            socket.disconnected.connect(open_files)
+
+    def open_window(self, file_to_open: Optional[str] = None) -> None:
+        """Open a new window, with a file if file_to_open isn't empty."""
+        settings = Settings(self.config_dir,
+                            command_history=self.command_history,
+                            config_files=self.config_files)
+        mainwindow = MainWindow()
+        controller = Controller(mainwindow, settings, self.dictionaries)
+        self.make_event_filter(controller)
+        mainwindow.closed.connect(lambda: self.close_window(controller))
+        controller.filehandler.new_window_requested.connect(self.open_window)
+        settings.css_changed.connect(self.setStyleSheet)
+        settings.reload_settings()
+        # The stylesheet is used by the whole application
+        if not self.windows:
+            settings.reload_stylesheet()
+        self.windows.append(controller)
         if file_to_open:
-            self.controller.filehandler.load_file_at_startup(file_to_open)
-        self.controller.init_done()
+            controller.filehandler.load_file_at_startup(file_to_open)
+        controller.init_done()
+        mainwindow.raise_()
+        mainwindow.activateWindow()
+
+    def close_window(self, controller: Controller) -> None:
+        if controller in self.windows:
+            controller.close()
+            self.windows.remove(controller)
+            controller.mainwindow.deleteLater()
 
-    def make_event_filter(self) -> None:
+    def make_event_filter(self, controller: Controller) -> None:
         class MainWindowEventFilter(QtCore.QObject):
             def eventFilter(self_, obj: QtCore.QObject,
                             event: QtCore.QEvent) -> bool:
                 if event.type() == QtCore.QEvent.Close:
-                    self.settings.save_settings()
+                    controller.filehandler.wait_for_saves()
+                    controller.recovery_journal.wait_for_writes()
+                    controller.settings.save_settings()
+                    controller.spellchecker.save_word_cache()
                 return False
-        self.close_filter = MainWindowEventFilter()
-        self.mainwindow.installEventFilter(self.close_filter)
+        close_filter = MainWindowEventFilter(controller.mainwindow)
+        controller.mainwindow.installEventFilter(close_filter)
 
 
 def main() -> None:
     import argparse
-    import subprocess
     import sys
     logging.basicConfig(format='%(asctime)s - %(name)s - '
                                '%(levelname)s - %(msg)s')
@@ -65,20 +182,24 @@ def main() -> None:
     parser.add_argument('-c', '--config-directory')
     parser.add_argument('-s', '--silent-mode', action='store_true',
                         help="hide non-error messages in the OS's terminal")
+    parser.add_argument('-i', '--new-instance', action='store_true',
+                        help="don't open the files in a Kalpana that's "
+                             "already running")
     parser.add_argument('files', nargs='*')
     args = parser.parse_args()
-    if not args.files:
-        app = Kalpana(args.config_directory, silent_mode=args.silent_mode)
-    else:
-        app = Kalpana(args.config_directory, file_to_open=args.files[0],
-                      silent_mode=args.silent_mode)
-        for f in args.files[1:]:
-            if args.silent_mode:
-                subprocess.Popen([sys.executable, sys.argv[0],
-                                  '-s', f.encode('utf-8')])
-            else:
-                subprocess.Popen([sys.executable, sys.argv[0],
-                                  f.encode('utf-8')])
+    config_dir = (Path(args.config_directory) if args.config_directory
+                  else default_config_dir())
+    name = server_name(config_dir)
+    if not args.new_instance \
+            and send_files_to_running_instance(name, args.files):
+        sys.exit(0)
+    app = Kalpana(args.config_directory,
+                  file_to_open=args.files[0] if args.files else None,
+                  silent_mode=args.silent_mode)
+    for f in args.files[1:]:
+        app.open_window(f)
+    if not args.new_instance:
+        app.listen()
     sys.exit(app.exec_())
 
 
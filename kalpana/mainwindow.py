@@ -41,6 +41,11 @@ class Stack(QtWidgets.QStackedWidget):
 
 
 class MainWindow(QtWidgets.QFrame, KalpanaObject):
+    # Emitted when the window has actually been closed
+    closed = mk_signal0()
+    # Emitted when the user chooses to close without saving
+    changes_discarded = mk_signal0()
+
     def __init__(self) -> None:
         super().__init__()
         self.kalpana_commands = [
@@ -91,9 +96,11 @@ class MainWindow(QtWidgets.QFrame, KalpanaObject):
             event.ignore()
         else:
             super().closeEvent(event)
+            self.closed.emit()
 
     def force_close(self, arg: str) -> None:
         self.force_close_flag = True
+        self.changes_discarded.emit()
         self.close()
 
     def check_for_sapfo_title(self) -> None:
@@ -0,0 +1,298 @@
+# Copyright nycz 2011-2020
+
+# This file is part of Kalpana.
+
+# Kalpana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Kalpana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A journal of all unsaved changes, to recover them after a crash.
+
+The journal starts with a header line that is either the text of the
+document (a checkpoint) or the size and modification time of the file on
+disk the changes are based on. Every line after that is a change in the
+form [position, chars removed, text added], which is appended to the
+journal every few seconds.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from PyQt5 import QtCore, QtGui
+
+from .common import KalpanaObject
+from .filehandler import write_file_safely
+
+logger = logging.getLogger(__name__)
+
+
+def _write_journals_in_background(
+        requests: 'queue.Queue[Optional[Tuple[str, Path, str]]]') -> None:
+    """
+    Write journals sent from the GUI thread, in the order they're sent.
+
+    Each request is a tuple of (action, path, text), where action is
+    "write" (replace the whole journal), "append" or "remove". None stops
+    the thread.
+    """
+    while True:
+        request = requests.get()
+        if request is None:
+            requests.task_done()
+            return
+        action, path, text = request
+        try:
+            if action == 'write':
+                write_file_safely(str(path), text)
+            elif action == 'remove':
+                path.unlink(missing_ok=True)
+            else:
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception:
+            logger.exception(f'Failed to write the recovery journal {path}')
+        finally:
+            requests.task_done()
+
+
+def replay_changes(text: str, changes: List[Tuple[int, int, str]]) -> str:
+    """Return the text with all changes applied in order."""
+    # Positions are in the document's own units, so replay them in one
+    document = QtGui.QTextDocument()
+    document.setPlainText(text)
+    cursor = QtGui.QTextCursor(document)
+    for pos, removed, added in changes:
+        end = document.characterCount() - 1
+        cursor.setPosition(min(pos, end))
+        cursor.setPosition(min(pos + removed, end),
+                           QtGui.QTextCursor.KeepAnchor)
+        cursor.insertText(added)
+    return document.toPlainText()
+
+
+class RecoveryJournal(QtCore.QObject, KalpanaObject):
+    """Keeps track of the changes to the open file since it was saved."""
+
+    # How often (in milliseconds) changes are written to the journal
+    write_interval = 5000
+
+    def __init__(self, config_dir: Path, document: QtGui.QTextDocument) -> None:
+        super().__init__()
+        self.document = document
+        self.journal_dir = config_dir / 'recovery'
+        self.journal_dir.mkdir(exist_ok=True, parents=True)
+        # No journal is kept for unnamed files
+        self.filepath: Optional[str] = None
+        self.journal_path: Optional[Path] = None
+        # The file the changes are based on, or None if the journal should
+        # start with a checkpoint of the whole text instead
+        self.base: Optional[Dict[str, int]] = None
+        self.header_written = False
+        self.checkpoint_needed = False
+        self.changes: List[Tuple[int, int, str]] = []
+        self.journal_size = 0
+        self.write_timer = QtCore.QTimer(self)
+        self.write_timer.setInterval(self.write_interval)
+        self.write_timer.setSingleShot(True)
+        self.write_timer.timeout.connect(self.write_changes)
+        self.write_requests: 'queue.Queue[Optional[Tuple[str, Path, str]]]' = \
+            queue.Queue()
+        self.write_thread = threading.Thread(
+            target=_write_journals_in_background,
+            args=(self.write_requests,),
+            daemon=True)
+        self.write_thread.start()
+
+    def _journal_path(self, filepath: str) -> Path:
+        path_hash = hashlib.sha1(os.path.abspath(filepath).encode('utf-8'))
+        return self.journal_dir / (path_hash.hexdigest() + '.journal')
+
+    @staticmethod
+    def _file_version(filepath: str) -> Optional[Dict[str, int]]:
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        return {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+    def file_opened(self, filepath: str, is_new: bool) -> None:
+        # Changes from before (including replacing the text) are irrelevant
+        self.changes.clear()
+        self.write_timer.stop()
+        self.filepath = filepath or None
+        self.journal_path = self._journal_path(filepath) if filepath else None
+        self.base = None if is_new else self._file_version(filepath)
+        self.header_written = False
+        self.checkpoint_needed = False
+        if filepath and not is_new:
+            self.offer_recovery()
+
+    def file_saved(self, filepath: str, new_name: bool) -> None:
+        # This is called after the modified flag has been cleared if the
+        # save had all the changes (see FileHandler.document_saved)
+        self.changes.clear()
+        self.write_timer.stop()
+        self.filepath = filepath
+        self.journal_path = self._journal_path(filepath)
+        self.base = self._file_version(filepath)
+        self.header_written = False
+        self.checkpoint_needed = False
+        if self.document.isModified():
+            # Some changes were made during the save, so they have to be
+            # written to a checkpoint
+            self.base = None
+            self.checkpoint_needed = True
+            self.write_timer.start()
+        else:
+            self.write_requests.put(('remove', self.journal_path, ''))
+
+    def contents_changed(self, pos: int, removed: int, added: int) -> None:
+        """Record a change to the document. (connected to contentsChange)"""
+        # Changes that can't be undone, like loading a file, aren't edits
+        if self.journal_path is None \
+                or not self.document.isUndoRedoEnabled():
+            return
+        cursor = QtGui.QTextCursor(self.document)
+        end = self.document.characterCount() - 1
+        cursor.setPosition(min(pos, end))
+        cursor.setPosition(min(pos + added, end), QtGui.QTextCursor.KeepAnchor)
+        text = cursor.selectedText().replace('\u2029', '\n')
+        self.changes.append((pos, removed, text))
+        if not self.write_timer.isActive():
+            self.write_timer.start()
+
+    def write_changes(self) -> None:
+        """Write all changes since the last time to the journal."""
+        if self.journal_path is None \
+                or not (self.changes or self.checkpoint_needed):
+            return
+        self.checkpoint_needed = False
+        if not self.header_written:
+            header: Dict[str, Any] = {'file': self.filepath}
+            if self.base is None:
+                # The checkpoint already includes all changes
+                header['text'] = self.document.toPlainText()
+                self.changes.clear()
+            else:
+                header['base'] = self.base
+            text = ''.join(json.dumps(line) + '\n'
+                           for line in [header] + self.changes)
+            self.write_requests.put(('write', self.journal_path, text))
+            self.header_written = True
+            self.journal_size = 0
+        else:
+            text = ''.join(json.dumps(change) + '\n'
+                           for change in self.changes)
+            self.write_requests.put(('append', self.journal_path, text))
+            self.journal_size += len(text)
+        self.changes.clear()
+        # Start over with a checkpoint once replaying would take too long
+        if self.journal_size > max(self.document.characterCount(), 100000):
+            self.base = None
+            self.header_written = False
+
+    def discard_changes(self) -> None:
+        """
+        Remove the journal, since the user chose to throw the changes away.
+
+        If the document is edited again afterwards, the journal starts over
+        with a checkpoint, since the changes so far aren't in it anymore.
+        """
+        self.changes.clear()
+        self.write_timer.stop()
+        self.base = None
+        self.header_written = False
+        self.checkpoint_needed = False
+        if self.journal_path is not None:
+            self.write_requests.put(('remove', self.journal_path, ''))
+            # The file might be opened again right away, and its old
+            # journal mustn't be offered
+            self.write_requests.join()
+
+    def close(self) -> None:
+        """Stop the background thread once the pending writes are done."""
+        self.write_timer.stop()
+        self.write_requests.put(None)
+        self.write_thread.join()
+
+    def wait_for_writes(self) -> None:
+        """Write all changes and block until they're on the disk."""
+        self.write_changes()
+        self.write_requests.join()
+
+    def recovered_text(self) -> Optional[str]:
+        """
+        Return the text with all changes in the journal applied.
+
+        Return None if there is no journal newer than the file or it doesn't
+        change anything.
+        """
+        if self.journal_path is None or self.filepath is None:
+            return None
+        try:
+            journal_mtime = self.journal_path.stat().st_mtime_ns
+            if journal_mtime <= os.stat(self.filepath).st_mtime_ns:
+                return None
+            lines = self.journal_path.read_text(encoding='utf-8').split('\n')
+            header = json.loads(lines[0])
+        except (IOError, json.JSONDecodeError):
+            return None
+        changes = []
+        for line in lines[1:]:
+            # The last line might be cut off if Kalpana crashed while writing
+            try:
+                pos, removed, added = json.loads(line)
+            except (ValueError, TypeError):
+                break
+            changes.append((pos, removed, added))
+        if 'text' in header:
+            text = str(header['text'])
+        elif header.get('base') == self._file_version(self.filepath):
+            text = self.document.toPlainText()
+        else:
+            # The file has changed since, so the changes don't fit anymore
+            return None
+        recovered_text = replay_changes(text, changes)
+        if recovered_text == self.document.toPlainText():
+            return None
+        return recovered_text
+
+    def offer_recovery(self) -> None:
+        with self.try_it("Couldn't check for changes to recover"):
+            if self.recovered_text() is not None:
+                assert self.journal_path is not None
+                mtime = datetime.datetime.fromtimestamp(
+                    self.journal_path.stat().st_mtime)
+                self.confirm(f'Found unsaved changes from '
+                             f'{mtime:%Y-%m-%d %H:%M}. Recover them?',
+                             self.recover)
+
+    def recover(self, arg: str) -> None:
+        """Replace the text with the recovered text. (confirm callback)"""
+        text = self.recovered_text()
+        if text is None:
+            self.error('The unsaved changes are gone')
+            return
+        cursor = QtGui.QTextCursor(self.document)
+        cursor.select(QtGui.QTextCursor.Document)
+        cursor.insertText(text)
+        self.log('Unsaved changes recovered')
@@ -20,7 +20,7 @@ import re
 from collections import defaultdict
 from pathlib import Path
 from typing import (Any, ChainMap, DefaultDict, Dict, Iterable, List, Mapping,
-                    Match, Optional, cast)
+                    Match, Optional, Tuple)
 
 import yaml
 from libsyntyche.widgets import mk_signal1
@@ -80,19 +80,65 @@ class CommandHistory:
         self._path.write_text(json_data)
 
 
+class ConfigFiles:
+    """
+    Parsed yaml config files, shared by all windows.
+
+    A file is only parsed again if it has changed since last time.
+    """
+
+    def __init__(self) -> None:
+        # The mtime and size of each file when it was parsed, and its config
+        self._configs: Dict[Path, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+
+    def load(self, config_path: Path) -> Dict[str, Any]:
+        """
+        Load a yaml config file.
+
+        If the file doesn't exist, return an empty dict.
+        If the yaml is invalid, raise yaml.YAMLError.
+
+        The dict is a copy, but the values in it are shared and shouldn't be
+        modified.
+        """
+        try:
+            stat = config_path.stat()
+            version = (stat.st_mtime_ns, stat.st_size)
+            cached = self._configs.get(config_path)
+            if cached is None or cached[0] != version:
+                raw_config = config_path.read_text()
+            else:
+                return dict(cached[1])
+        except OSError:
+            return {}
+        config = yaml.safe_load(yaml_escape_unicode(raw_config))
+        if not isinstance(config, dict):
+            raise yaml.YAMLError('root type has to be a dict')
+        self._configs[config_path] = (version, config)
+        return dict(config)
+
+
 class Settings(QtCore.QObject, KalpanaObject):
     """Loads and takes care of settings and stylesheets."""
 
     css_changed = mk_signal1(str)
 
-    def __init__(self, config_dir: Optional[Path]) -> None:
-        """Initiate the class. Note that this won't load any files."""
+    def __init__(self, config_dir: Optional[Path],
+                 command_history: Optional[CommandHistory] = None,
+                 config_files: Optional[ConfigFiles] = None) -> None:
+        """
+        Initiate the class. Note that this won't load any files.
+
+        The command history and config files can be shared with the
+        settings of other windows.
+        """
         super().__init__()
         self.config_dir = config_dir or default_config_dir()
         self.config_dir.mkdir(parents=True, exist_ok=True)
         self.active_file: str = ''
         self.registered_settings: Dict[str, List[KalpanaObject]] = {}
-        self.command_history = CommandHistory(self.config_dir)
+        self.command_history = command_history or CommandHistory(self.config_dir)
+        self.config_files = config_files or ConfigFiles()
         self.settings: ChainMap[str, Any] = ChainMap()
         self.key_bindings: Dict[int, str] = {}
         self.terminal_key = -1
@@ -170,24 +216,15 @@ class Settings(QtCore.QObject, KalpanaObject):
         Load a yaml config file.
 
         If the file doesn't exist, return an empty dict.
-        If the yaml is invalid, return None.
+        If the yaml is invalid, raise yaml.YAMLError.
         """
-        try:
-            raw_config = config_path.read_text()
-        except OSError:
-            return {}
-        else:
-            config = yaml.safe_load(yaml_escape_unicode(raw_config))
-            if not isinstance(config, dict):
-                raise yaml.YAMLError('root type has to be a dict')
-            return config
+        return self.config_files.load(config_path)
 
     def load_settings(self, config_dir: Path) -> ChainMap[str, Any]:
         """Read and return the settings, with default values overriden."""
         # Default config
         default_config_path = LOCAL_DATA_DIR / 'default_settings.yaml'
-        default_config = cast(Dict[str, Any],
-                              yaml.safe_load(default_config_path.read_text()))
+        default_config = self._load_yaml_file(default_config_path)
         # Global config
         global_config_path = config_dir / 'settings.yaml'
         global_config: Dict[str, Any] = {}
@@ -200,7 +237,8 @@ class Settings(QtCore.QObject, KalpanaObject):
         file_config: Dict[str, Any] = {}
         try:
             all_files_config = self._load_yaml_file(all_files_config_path)
-            file_config = all_files_config.get(self.active_file, {})
+            # Changed settings are written to this, so it can't be shared
+            file_config = dict(all_files_config.get(self.active_file, {}))
         except yaml.YAMLError as e:
             self.error(f'Invalid yaml in the file config: {e}')
         new_settings = ChainMap(file_config, global_config, default_config)
@@ -15,16 +15,55 @@
 # You should have received a copy of the GNU General Public License
 # along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
 
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional
+from typing import (Any, Callable, Dict, Iterable, List, Optional, Set,
+                    Tuple)
 
 import enchant
 from libsyntyche.cli import ArgumentRules, AutocompletionPattern, Command
-from libsyntyche.widgets import mk_signal0, mk_signal1
+from libsyntyche.widgets import mk_signal0, mk_signal1, mk_signal2
 from PyQt5 import QtCore
 
 from .common import KalpanaObject, command_callback
 
+logger = logging.getLogger(__name__)
+
+# Smaller caches would keep dropping the words used all the time
+MIN_WORD_CACHE_SIZE = 5000
+# Caches of dictionaries whose files can't be found are thrown away after
+# this many seconds, in case the dictionary has changed
+WORD_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+
+def _dictionary_dirs() -> List[Path]:
+    """
+    Return the directories where enchant's providers look for dictionaries.
+
+    Enchant doesn't tell which files a dictionary is made of, so this covers
+    the usual places of hunspell, myspell and aspell dictionaries.
+    """
+    config_home = Path(os.environ.get('XDG_CONFIG_HOME')
+                       or Path.home() / '.config')
+    enchant_config = Path(os.environ.get('ENCHANT_CONFIG_DIR')
+                          or config_home / 'enchant')
+    dirs = [Path(path) for path in os.environ.get('DICPATH', '').split(os.pathsep)
+            if path]
+    dirs += [enchant_config / 'hunspell', enchant_config / 'myspell']
+    for prefix in ['/usr/local/share', '/usr/share']:
+        dirs += [Path(prefix, 'hunspell'), Path(prefix, 'myspell'),
+                 Path(prefix, 'myspell', 'dicts')]
+    for prefix in ['/usr/lib', '/usr/lib64']:
+        dirs += [Path(prefix, 'aspell'), Path(prefix, 'aspell-0.60')]
+    return dirs
+
 
 def get_spellcheck_languages(name: str, text: str) -> List[str]:
     """Return a list with the tags of all available spellcheck languages."""
@@ -45,17 +84,342 @@ def _get_word_if_missing(word_command: Callable[['Spellchecker', str], None]
     return wrapper
 
 
+def _check_words_in_background(
+        pwl_path: Path,
+        requests: 'queue.Queue[Tuple[str, str, List[str]]]',
+        words_checked: Callable[[str, Dict[str, Optional[bool]]], None],
+        suggestions_found: Callable[[str, Dict[str, Optional[List[str]]]], None]
+) -> None:
+    """
+    Spellcheck words sent from the GUI thread.
+
+    Each request is a tuple of (action, language, words), where action is
+    "check", "suggest" or "add". Checked words are passed to words_checked
+    and suggestions to suggestions_found. If a request fails, its words are
+    passed on anyway with None as the result, so they don't stay pending
+    forever. The dictionaries are only used in this thread and are
+    separate from the ones in the GUI thread.
+    """
+    language_dicts: Dict[str, Any] = {}
+    while True:
+        action, language, words = requests.get()
+        try:
+            language_dict = language_dicts.get(language)
+            if language_dict is None:
+                pwl = pwl_path / (language + '.pwl')
+                language_dict = enchant.DictWithPWL(language, pwl=str(pwl))
+                language_dicts[language] = language_dict
+            if action == 'add':
+                for word in words:
+                    language_dict.add_to_session(word)
+            elif action == 'suggest':
+                suggestions_found(language, {
+                    word: language_dict.suggest(word)[:5] for word in words})
+            else:
+                words_checked(language, {word: language_dict.check(word)
+                                         for word in words})
+        except Exception:
+            logger.exception(f'Failed to {action} words in {language}')
+            if action == 'suggest':
+                suggestions_found(language, dict.fromkeys(words))
+            elif action == 'check':
+                words_checked(language, dict.fromkeys(words))
+
+
+class SpellcheckDictionaries(QtCore.QObject):
+    """
+    The spellcheck dictionaries and caches, shared by all windows.
+
+    Words are checked and suggestions are made in two background threads,
+    so slow suggestions never hold up the spellchecking.
+    words_cached and suggestions_cached are emitted when the results are in,
+    since any window might be waiting for them.
+    """
+
+    words_checked = mk_signal2(str, dict)
+    suggestions_found = mk_signal2(str, dict)
+    # (language, misspelled words)
+    words_cached = mk_signal2(str, list)
+    # (language, words)
+    suggestions_cached = mk_signal2(str, list)
+
+    def __init__(self, config_dir: Path) -> None:
+        super().__init__()
+        # All languages used so far
+        self.language_dicts: Dict[str, Any] = {}
+        self.invalid_languages: Set[str] = set()
+        self.existing_languages: Set[str] = set()
+        # Each language's cache is saved to disk and loaded the first time
+        # it's needed. Least recently used words are first and get dropped
+        # when a cache is full.
+        self.word_caches: Dict[str, 'OrderedDict[str, bool]'] = {}
+        self.word_cache_times: Dict[str, float] = {}
+        self.modified_word_caches: Set[str] = set()
+        self.dictionary_dirs = _dictionary_dirs()
+        self.word_cache_size = 100000
+        # Every window has its own cache size setting and the biggest is used
+        self.word_cache_size_requests: Dict[object, int] = {}
+        self.word_cache_hits = 0
+        self.word_cache_misses = 0
+        self.word_cache_evictions = 0
+        # Words that aren't cached are checked in a background thread
+        self.unchecked_words: Dict[str, Set[str]] = {}
+        self.pending_words: Set[Tuple[str, str]] = set()
+        self.check_words_timer = QtCore.QTimer(self)
+        self.check_words_timer.setInterval(0)
+        self.check_words_timer.setSingleShot(True)
+        self.check_words_timer.timeout.connect(self.check_pending_words)
+        self.words_checked.connect(self.add_checked_words)
+        # Suggestions are slow, so they're made in their own thread, a few
+        # words at a time so each batch shows up quickly
+        self.suggestion_caches: Dict[str, Dict[str, List[str]]] = {}
+        self.pending_suggestions: Set[Tuple[str, str]] = set()
+        self.suggestion_batch_size = 10
+        self.suggestions_found.connect(self.add_suggestions)
+        self.pwl_path = config_dir / 'spellcheck-pwl'
+        self.pwl_path.mkdir(exist_ok=True, parents=True)
+        self.cache_path = config_dir / 'spellcheck-cache'
+        self.cache_path.mkdir(exist_ok=True, parents=True)
+        self.check_requests: 'queue.Queue[Tuple[str, str, List[str]]]' \
+            = queue.Queue()
+        self.check_thread = threading.Thread(
+            target=_check_words_in_background,
+            args=(self.pwl_path, self.check_requests, self.words_checked.emit,
+                  self.suggestions_found.emit),
+            daemon=True)
+        self.check_thread.start()
+        self.suggestion_requests: 'queue.Queue[Tuple[str, str, List[str]]]' \
+            = queue.Queue()
+        self.suggestion_thread = threading.Thread(
+            target=_check_words_in_background,
+            args=(self.pwl_path, self.suggestion_requests,
+                  self.words_checked.emit, self.suggestions_found.emit),
+            daemon=True)
+        self.suggestion_thread.start()
+
+    def get_language_dict(self, language: str) -> Optional[Any]:
+        """Return a language's dictionary, or None if there isn't one."""
+        language_dict = self.language_dicts.get(language)
+        if language_dict is None and language not in self.invalid_languages:
+            try:
+                pwl = self.pwl_path / (language + '.pwl')
+                language_dict = enchant.DictWithPWL(language, pwl=str(pwl))
+            except enchant.errors.DictNotFoundError:
+                self.invalid_languages.add(language)
+            else:
+                self.language_dicts[language] = language_dict
+        return language_dict
+
+    def language_exists(self, language: str) -> bool:
+        """Return if a language has a dictionary, without loading it."""
+        if language in self.language_dicts or language in self.existing_languages:
+            return True
+        if language in self.invalid_languages:
+            return False
+        if enchant.dict_exists(language):
+            self.existing_languages.add(language)
+            return True
+        self.invalid_languages.add(language)
+        return False
+
+    def add_word(self, language: str, word: str) -> None:
+        """Add a word to a language's word list."""
+        self.language_dicts[language].add_to_pwl(word)
+        # Both threads have their own dictionaries
+        self.check_requests.put(('add', language, [word]))
+        self.suggestion_requests.put(('add', language, [word]))
+        if language not in self.word_caches:
+            self.load_word_cache(language)
+        self._cache_word(language, word, True)
+        # The new word might be a better suggestion for other words
+        self.suggestion_caches.pop(language, None)
+
+    def request_suggestions(self, language: str, words: Iterable[str]) -> None:
+        """Make suggestions for the words that aren't already being made."""
+        new_words = [word for word in words
+                     if (language, word) not in self.pending_suggestions]
+        if new_words:
+            self.pending_suggestions.update((language, word)
+                                            for word in new_words)
+            for i in range(0, len(new_words), self.suggestion_batch_size):
+                batch = new_words[i:i + self.suggestion_batch_size]
+                self.suggestion_requests.put(('suggest', language, batch))
+
+    def add_suggestions(self, language: str,
+                        results: Dict[str, Optional[List[str]]]) -> None:
+        """Cache the suggestions made in the background thread."""
+        self.pending_suggestions.difference_update(
+            (language, word) for word in results)
+        # Words that failed can be requested again later
+        suggestions = {word: result for word, result in results.items()
+                       if result is not None}
+        self.suggestion_caches.setdefault(language, {}).update(suggestions)
+        if suggestions:
+            self.suggestions_cached.emit(language, list(suggestions))
+
+    def check_word(self, word: str, language: str) -> Optional[bool]:
+        """
+        Return if a word is spelled correctly in a (valid) language.
+
+        Return None if the word hasn't been checked yet. It will then be
+        checked in the background.
+        """
+        word_cache = self.word_caches.get(language)
+        if word_cache is None:
+            word_cache = self.load_word_cache(language)
+        try:
+            result = word_cache[word]
+        except KeyError:
+            self.word_cache_misses += 1
+            if (language, word) not in self.pending_words:
+                self.unchecked_words.setdefault(language, set()).add(word)
+                self.check_words_timer.start()
+            return None
+        else:
+            self.word_cache_hits += 1
+            word_cache.move_to_end(word)
+        return result
+
+    def check_pending_words(self) -> None:
+        """Send the words that need checking to the background thread."""
+        for language, words in self.unchecked_words.items():
+            self.check_requests.put(('check', language, list(words)))
+            self.pending_words.update((language, word) for word in words)
+        self.unchecked_words.clear()
+
+    def add_checked_words(self, language: str,
+                          results: Dict[str, Optional[bool]]) -> None:
+        """Cache the words checked in the background thread."""
+        self.pending_words.difference_update(
+            (language, word) for word in results)
+        word_cache = self.word_caches.get(language)
+        if word_cache is None:
+            return
+        misspelled_words = []
+        for word, result in results.items():
+            # Words that failed are checked again the next time they're seen
+            if result is None:
+                continue
+            # Don't overwrite words added to the dictionary in the meantime
+            if word not in word_cache:
+                self._cache_word(language, word, result)
+                if not result:
+                    misspelled_words.append(word)
+        if misspelled_words:
+            self.words_cached.emit(language, misspelled_words)
+
+    def _cache_word(self, language: str, word: str, result: bool) -> None:
+        word_cache = self.word_caches[language]
+        word_cache[word] = result
+        word_cache.move_to_end(word)
+        self.modified_word_caches.add(language)
+        self._trim_word_cache(word_cache)
+
+    def _trim_word_cache(self, word_cache: 'OrderedDict[str, bool]') -> None:
+        while len(word_cache) > self.word_cache_size:
+            word_cache.popitem(last=False)
+            self.word_cache_evictions += 1
+
+    def request_word_cache_size(self, window: object, size: Optional[int]
+                                ) -> None:
+        """Set (or with None, forget) the cache size a window wants."""
+        if size is None:
+            self.word_cache_size_requests.pop(window, None)
+        else:
+            self.word_cache_size_requests[window] = size
+        self.word_cache_size = max(self.word_cache_size_requests.values(),
+                                   default=self.word_cache_size)
+        for word_cache in self.word_caches.values():
+            self._trim_word_cache(word_cache)
+
+    def _word_cache_file(self, language: str) -> Path:
+        return self.cache_path / (language + '.json')
+
+    def _word_cache_version(self, language: str) -> Dict[str, Any]:
+        """
+        Return what the cached words depend on.
+
+        If any of this changes, the cache is outdated.
+        """
+        pwl = self.pwl_path / (language + '.pwl')
+        try:
+            stat = pwl.stat()
+        except OSError:
+            pwl_version = None
+        else:
+            pwl_version = [stat.st_mtime_ns, stat.st_size]
+        dictionary_files = []
+        for directory in self.dictionary_dirs:
+            for path in sorted(directory.glob(glob.escape(language) + '.*')):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                dictionary_files.append([str(path), stat.st_mtime_ns,
+                                         stat.st_size])
+        return {'pwl': pwl_version, 'dictionary': dictionary_files}
+
+    def load_word_cache(self, language: str) -> 'OrderedDict[str, bool]':
+        """Load the saved words for a language, if they're still valid."""
+        word_cache: 'OrderedDict[str, bool]' = OrderedDict()
+        self.word_caches[language] = word_cache
+        self.word_cache_times[language] = time.time()
+        try:
+            data: Dict[str, Any] = json.loads(
+                self._word_cache_file(language).read_text(encoding='utf-8'))
+            version = data['version']
+            created = data['created']
+            correct_words = data['correct']
+            incorrect_words = data['incorrect']
+        except (IOError, KeyError, json.JSONDecodeError):
+            return word_cache
+        if version != self._word_cache_version(language):
+            return word_cache
+        if not version['dictionary'] \
+                and time.time() - created > WORD_CACHE_MAX_AGE:
+            return word_cache
+        self.word_cache_times[language] = created
+        word_cache.update(OrderedDict.fromkeys(correct_words, True))
+        word_cache.update(OrderedDict.fromkeys(incorrect_words, False))
+        self._trim_word_cache(word_cache)
+        return word_cache
+
+    def save_word_cache(self, language: str) -> None:
+        """Save the checked words for a language to disk."""
+        word_cache = self.word_caches[language]
+        data = {
+            'version': self._word_cache_version(language),
+            'created': self.word_cache_times[language],
+            'correct': [w for w, ok in word_cache.items() if ok],
+            'incorrect': [w for w, ok in word_cache.items() if not ok],
+        }
+        path = self._word_cache_file(language)
+        temp_path = path.with_name(path.name + '.tmp')
+        temp_path.write_text(json.dumps(data, ensure_ascii=False),
+                             encoding='utf-8')
+        os.replace(temp_path, path)
+        self.modified_word_caches.discard(language)
+
+
 class Spellchecker(QtCore.QObject, KalpanaObject):
 
     rehighlight = mk_signal0()
-    rehighlight_word = mk_signal1(str)
+    rehighlight_words = mk_signal1(list)
 
-    def __init__(self, config_dir: Path,
-                 word_under_cursor: Callable[[], Optional[str]]) -> None:
+    def __init__(self, dictionaries: SpellcheckDictionaries,
+                 word_under_cursor: Callable[[], Optional[str]],
+                 language_under_cursor: Callable[[], str]) -> None:
         super().__init__()
-        self.word_cache: Dict[str, bool] = {}
+        # The dictionaries are shared with the other windows, but every
+        # window has its own default language
+        self.dictionaries = dictionaries
+        self.dictionaries.words_cached.connect(self.words_cached)
+        self.dictionaries.suggestions_cached.connect(self.suggestions_cached)
+        self.requested_suggestion: Optional[Tuple[str, str]] = None
         self.word_under_cursor = word_under_cursor
-        self.kalpana_settings = ['spellcheck-active', 'spellcheck-language']
+        self.language_under_cursor = language_under_cursor
+        self.kalpana_settings = ['spellcheck-active', 'spellcheck-language',
+                                 'spellcheck-cache-size']
         self.kalpana_commands = [
                 Command('toggle-spellcheck', 'Toggle the spellcheck.',
                         self.toggle_spellcheck,
@@ -94,12 +458,21 @@ class Spellchecker(QtCore.QObject, KalpanaObject):
                                       illegal_chars=' ')
         ]
         self.language = 'en_US'
-        self.pwl_path = config_dir / 'spellcheck-pwl'
-        self.pwl_path.mkdir(exist_ok=True, parents=True)
-        pwl = self.pwl_path / (self.language + '.pwl')
-        self.language_dict = enchant.DictWithPWL(self.language, pwl=str(pwl))
+        self.dictionaries.get_language_dict(self.language)
         self.spellcheck_active = False
 
+    def close(self) -> None:
+        """Stop listening to the shared dictionaries."""
+        self.dictionaries.words_cached.disconnect(self.words_cached)
+        self.dictionaries.suggestions_cached.disconnect(self.suggestions_cached)
+        self.dictionaries.request_word_cache_size(self, None)
+
+    def _valid_language(self, language: str) -> str:
+        """Return the language, or the default language if it's invalid."""
+        if not language or self.dictionaries.get_language_dict(language) is None:
+            return self.language
+        return language
+
     @command_callback
     @_get_word_if_missing
     def add_word(self, word: str) -> None:
@@ -107,32 +480,91 @@ class Spellchecker(QtCore.QObject, KalpanaObject):
         Add a word to the spellcheck dictionary.
 
         This automatically saves the word to the wordlist file as well.
+        The word is added to the language used where the cursor is.
         """
-        self.language_dict.add_to_pwl(word)
-        self.word_cache[word] = True
-        self.rehighlight_word.emit(word)
-        self.log(f'Added "{word}" to dictionary')
+        language = self._valid_language(self.language_under_cursor())
+        self.dictionaries.add_word(language, word)
+        self.rehighlight_words.emit([word])
+        self.log(f'Added "{word}" to dictionary ({language})')
 
     @command_callback
     @_get_word_if_missing
     def suggest(self, word: str) -> None:
         """Print spelling suggestions for a certain word."""
-        suggestions = ', '.join(self.language_dict.suggest(word)[:5])
+        language = self._valid_language(self.language_under_cursor())
+        if word in self.dictionaries.suggestion_caches.get(language, {}):
+            self._print_suggestions(language, word)
+            return
+        self.requested_suggestion = (language, word)
+        self.dictionaries.request_suggestions(language, [word])
+
+    def _print_suggestions(self, language: str, word: str) -> None:
+        suggestions = ', '.join(
+            self.dictionaries.suggestion_caches[language][word])
         self.log(f'{word}: {suggestions}')
 
-    def check_word(self, word: str) -> bool:
-        """A callback for the highlighter to check a word's spelling."""
-        if word in self.word_cache:
-            return self.word_cache[word]
-        result = self.language_dict.check(word)
-        self.word_cache[word] = result
-        return result
+    def prefetch_suggestions(self, language: str,
+                             words: Iterable[str]) -> None:
+        """Make suggestions in the background for any misspelled words."""
+        language = self._valid_language(language)
+        word_cache: Dict[str, bool] = self.dictionaries.word_caches.get(language, {})
+        suggestion_cache = self.dictionaries.suggestion_caches.get(language, {})
+        self.dictionaries.request_suggestions(language, [
+            word for word in words
+            if word_cache.get(word) is False and word not in suggestion_cache
+        ])
+
+    def suggestions_cached(self, language: str, words: List[str]) -> None:
+        if self.requested_suggestion is not None:
+            requested_language, requested_word = self.requested_suggestion
+            if requested_language == language and requested_word in words:
+                self._print_suggestions(language, requested_word)
+                self.requested_suggestion = None
+
+    def check_word(self, word: str, language: str = '') -> Optional[bool]:
+        """
+        A callback for the highlighter to check a word's spelling.
+
+        An empty language means the default language. Return None if the
+        word hasn't been checked yet. It will then be checked in the
+        background and rehighlight_words is emitted if it turns out to be
+        misspelled.
+        """
+        # The dictionary is only loaded in the background thread
+        if not self.language_exists(language):
+            language = self.language
+        return self.dictionaries.check_word(word, language)
+
+    def language_exists(self, language: str) -> bool:
+        """Return if there is a dictionary for a (non-empty) language."""
+        return bool(language) and self.dictionaries.language_exists(language)
+
+    def words_cached(self, language: str, misspelled_words: List[str]) -> None:
+        # Rehighlighting words that aren't in this window does nothing
+        self.rehighlight_words.emit(misspelled_words)
+
+    def save_word_cache(self) -> None:
+        """Save the checked words for all languages to disk."""
+        for language in sorted(self.dictionaries.modified_word_caches):
+            with self.try_it("Couldn't save the spellcheck cache"):
+                self.dictionaries.save_word_cache(language)
 
     def setting_changed(self, name: str, new_value: Any) -> None:
         if name == 'spellcheck-active':
             self.spellcheck_active = bool(new_value)
         elif name == 'spellcheck-language':
             self._change_language(str(new_value))
+        elif name == 'spellcheck-cache-size':
+            try:
+                size = int(new_value)
+            except (TypeError, ValueError):
+                self.error(f'Invalid spellcheck cache size: {new_value!r}')
+                return
+            if size < MIN_WORD_CACHE_SIZE:
+                self.error(f'Spellcheck cache size has to be at least '
+                           f'{MIN_WORD_CACHE_SIZE}!')
+                return
+            self.dictionaries.request_word_cache_size(self, size)
 
     @command_callback
     def set_language(self, language: str) -> None:
@@ -144,12 +576,11 @@ class Spellchecker(QtCore.QObject, KalpanaObject):
         if not language:
             self.error('No language specified')
             return
-        try:
-            pwl = self.pwl_path / (language + '.pwl')
-            self.language_dict = enchant.DictWithPWL(language, pwl=str(pwl))
-        except enchant.errors.DictNotFoundError:
+        if self.dictionaries.get_language_dict(language) is None:
             self.error(f'Invalid language: {language}')
-        else:
+        elif language != self.language:
+            # The caches of the other languages are kept, so only the words
+            # in blocks using the default language have to be rechecked
             self.language = language
             self.rehighlight.emit()
 
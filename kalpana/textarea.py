@@ -17,10 +17,13 @@
 
 import logging
 import re
-from typing import Any, Callable, Iterable, Optional, Tuple
+import time
+from typing import (AbstractSet, Any, Callable, Iterable, List, Optional,
+                    Tuple, cast)
 
 from libsyntyche.cli import ArgumentRules, Command
 from libsyntyche.texteditor import Searcher
+from libsyntyche.widgets import Signal1
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt
 
@@ -89,7 +92,24 @@ class TextArea(QtWidgets.QPlainTextEdit, KalpanaObject):
                         self.searcher.search_next,
                         args=ArgumentRules.NONE, short_name='*'),
         ]
+        # The geometry of the visible blocks, shared by everything painted in
+        # the same frame. It's only valid as long as the key (the first
+        # visible block, the content offset and the viewport size) matches
+        # and the document hasn't been laid out again.
+        self._block_layout: Optional[List[Tuple[QtCore.QRectF, QtGui.QTextBlock]]] = None
+        self._block_layout_key: Tuple[int, QtCore.QPointF, QtCore.QSize] \
+            = (-1, QtCore.QPointF(), QtCore.QSize())
+        cast(Signal1[QtCore.QRectF], self.document().documentLayout().update
+             ).connect(lambda _: self.invalidate_block_layout())
+        # The numbers of the blocks that are horizontal rulers
+        self.get_hr_blocks: Callable[[], AbstractSet[int]] = frozenset
+        # How many frames have been painted and how long it took in total,
+        # to make sure painting doesn't change the layout
+        self.frames_painted = 0
+        self.paint_time = 0.0
         self.line_number_bar = LineNumberBar(self)
+        self.updateRequest.connect(lambda rect, dy: self.line_number_bar.update())
+        self.blockCountChanged.connect(self.line_number_bar.update_digit_count)
         self.saved_position = (self.textCursor().position(),
                                self.verticalScrollBar().value())
 
@@ -100,7 +120,7 @@ class TextArea(QtWidgets.QPlainTextEdit, KalpanaObject):
                 self.saved_position = new_pos
                 self.change_setting('start-at-pos', list(new_pos))
 
-        self.cursor_timer = QtCore.QTimer()
+        self.cursor_timer = QtCore.QTimer(self)
         self.cursor_timer.setInterval(5000)
         self.cursor_timer.setSingleShot(False)
         self.cursor_timer.timeout.connect(update_cursor_position)
@@ -129,7 +149,7 @@ class TextArea(QtWidgets.QPlainTextEdit, KalpanaObject):
         self.setCursorWidth(3)
         self._insert_mode = False
         self.in_leader = False
-        self.leader_timer = QtCore.QTimer()
+        self.leader_timer = QtCore.QTimer(self)
         self.leader_timer.setInterval(500)
         self.leader_timer.setSingleShot(True)
 
@@ -204,9 +224,27 @@ class TextArea(QtWidgets.QPlainTextEdit, KalpanaObject):
         self.change_setting('show-line-numbers',
                             self.line_number_bar.isVisible())
 
-    def file_saved(self, filepath: str, new_name: bool) -> None:
+    def document_saved(self) -> None:
         self.document().setModified(False)
 
+    def invalidate_block_layout(self) -> None:
+        self._block_layout = None
+
+    def visible_block_layout(self) -> List[Tuple[QtCore.QRectF, QtGui.QTextBlock]]:
+        """
+        Return the geometry of the visible blocks.
+
+        This is cached, so painting the horizontal rulers and the line numbers
+        in the same frame only has to go through the blocks once. The rects
+        are shared and must not be modified.
+        """
+        key = (self.firstVisibleBlock().blockNumber(), self.contentOffset(),
+               self.viewport().size())
+        if self._block_layout is None or key != self._block_layout_key:
+            self._block_layout = list(self.visible_blocks())
+            self._block_layout_key = key
+        return self._block_layout
+
     def visible_blocks(self) -> Iterable[Tuple[QtCore.QRectF, QtGui.QTextBlock]]:
         page_bottom = self.viewport().height()
         viewport_offset = self.contentOffset()
@@ -236,13 +274,15 @@ class TextArea(QtWidgets.QPlainTextEdit, KalpanaObject):
             self.normal_mode_key_event(event)
 
     def paintEvent(self, event: QtGui.QPaintEvent) -> None:
-        if not self.line_number_bar.isVisible():
-            self.setViewportMargins(0, 0, 0, 0)
+        start_time = time.perf_counter()
+        margin_changes = self.line_number_bar.margin_changes
         super().paintEvent(event)
         with self.try_it("horizontal ruler couldn't be drawn"):
             self.draw_horizontal_ruler()
-        if self.line_number_bar.isVisible():
-            self.line_number_bar.update()
+        if self.line_number_bar.margin_changes != margin_changes:
+            logger.warning('The viewport margins changed while painting')
+        self.frames_painted += 1
+        self.paint_time += time.perf_counter() - start_time
 
     def draw_horizontal_ruler(self) -> None:
         painter = QtGui.QPainter(self.viewport())
@@ -250,8 +290,24 @@ class TextArea(QtWidgets.QPlainTextEdit, KalpanaObject):
         fg = self.palette().windowText().color()
         fg.setAlphaF(0.4)
         painter.setPen(QtGui.QPen(QtGui.QBrush(fg), 2))
-        for rect, block in self.visible_blocks():
-            if block.userState() & TextBlockState.HR and block != self.textCursor().block():
+        block_layout = self.visible_block_layout()
+        if not block_layout:
+            painter.end()
+            return
+        first_block = block_layout[0][1].blockNumber()
+        visible = range(first_block, first_block + len(block_layout))
+        hr_blocks = self.get_hr_blocks()
+        # Go through whichever is shorter
+        if len(hr_blocks) < len(visible):
+            visible_hr_blocks = [n for n in hr_blocks if n in visible]
+        else:
+            visible_hr_blocks = [n for n in visible if n in hr_blocks]
+        # The ruler isn't drawn where the cursor is, to show the asterisks
+        cursor_block = self.textCursor().blockNumber()
+        for block_number in visible_hr_blocks:
+            rect, block = block_layout[block_number - first_block]
+            if block_number != cursor_block \
+                    and block.userState() & TextBlockState.HR:
                 x1 = int(rect.x() + rect.width()*hrmargin)
                 x2 = int(rect.x() + rect.width()*(1-hrmargin))
                 y = int(rect.y() + rect.height()*0.5)
@@ -289,31 +345,61 @@ class TextArea(QtWidgets.QPlainTextEdit, KalpanaObject):
 
 
 class LineNumberBar(QtWidgets.QFrame):
+    """
+    The line numbers to the left of the text.
+
+    The bar's width depends only on its font and the number of digits in the
+    last line number, and the text area's left margin only on the width and
+    whether the bar is hidden. Both are updated when (and only when) one of
+    those change, never while painting.
+    """
+
     def __init__(self, parent: TextArea) -> None:
         super().__init__(parent)
         self.textarea = parent
         self.text_margin = 2
-
-    def update(self) -> None:  # type: ignore
+        self.digit_count = len(str(self.textarea.blockCount()))
+        # The left margin currently set on the text area
+        self.margin = 0
+        self.margin_changes = 0
+        self.update_width()
+
+    def update_digit_count(self, block_count: int) -> None:
+        digit_count = len(str(block_count))
+        if digit_count != self.digit_count:
+            self.digit_count = digit_count
+            self.update_width()
+
+    def update_width(self) -> None:
         left_margin, _, right_margin, _ = self.getContentsMargins()
-        total_lines = self.textarea.blockCount()
         font = self.font()
         font.setBold(True)
         font_metrics = QtGui.QFontMetricsF(font)
+        digit_width = max(font_metrics.width(str(n)) for n in range(10))
         max_width = int(sum([left_margin, right_margin,
-                             font_metrics.width(str(total_lines)),
+                             digit_width * self.digit_count,
                              2 * self.text_margin]))
-        self.setFixedWidth(max_width)
-        self.textarea.setViewportMargins(max_width, 0, 0, 0)
-        super().update()
-
-    def hideEvent(self, event: QtGui.QHideEvent) -> None:
-        super().hideEvent(event)
-        self.textarea.setViewportMargins(0, 0, 0, 0)
-
-    def showEvent(self, event: QtGui.QShowEvent) -> None:
-        super().showEvent(event)
-        self.textarea.setViewportMargins(self.width(), 0, 0, 0)
+        if max_width != self.width():
+            self.setFixedWidth(max_width)
+        self.update_margin()
+
+    def update_margin(self) -> None:
+        margin = 0 if self.isHidden() else self.width()
+        if margin != self.margin:
+            self.margin = margin
+            self.margin_changes += 1
+            self.textarea.setViewportMargins(margin, 0, 0, 0)
+
+    def setVisible(self, visible: bool) -> None:
+        super().setVisible(visible)
+        self.update_margin()
+
+    def changeEvent(self, event: QtCore.QEvent) -> None:
+        super().changeEvent(event)
+        # The digits have to be measured again
+        if event.type() in {QtCore.QEvent.FontChange,
+                            QtCore.QEvent.StyleChange}:
+            self.update_width()
 
     def paintEvent(self, event: QtGui.QPaintEvent) -> None:
         super().paintEvent(event)
@@ -321,19 +407,13 @@ class LineNumberBar(QtWidgets.QFrame):
         main_rect.setTop(self.rect().top())
         main_rect.setHeight(self.rect().height())
         painter = QtGui.QPainter(self)
-        viewport_offset = self.textarea.contentOffset()
-        page_bottom = self.textarea.viewport().height()
         current_block = self.textarea.textCursor().block()
-        block = self.textarea.firstVisibleBlock()
         text_align = QtGui.QTextOption(QtCore.Qt.AlignRight)
         font = painter.font()
-        while block.isValid():
-            rect = self.textarea.blockBoundingGeometry(block)\
-                .translated(viewport_offset)
+        for block_rect, block in self.textarea.visible_block_layout():
+            rect = QtCore.QRectF(block_rect)
             rect.setLeft(main_rect.left())
             rect.setWidth(main_rect.width())
-            if rect.y() > page_bottom:
-                break
             if block == current_block:
                 font.setBold(True)
                 painter.setFont(font)
@@ -343,5 +423,4 @@ class LineNumberBar(QtWidgets.QFrame):
             tm = self.text_margin
             painter.drawText(rect.adjusted(tm, tm/2, -tm, -tm/2),
                              str(block.blockNumber()+1), option=text_align)
-            block = block.next()
         painter.end()
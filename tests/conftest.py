@@ -0,0 +1,51 @@
+import os
+from typing import Callable, Iterator, List, Tuple
+
+import pytest
+from PyQt5 import QtGui, QtWidgets
+
+# The tests don't need a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from kalpana.highlighter import Highlighter  # noqa: E402
+
+
+def _make_highlighter() -> Tuple[QtGui.QTextDocument, Highlighter]:
+    """Return a new empty document and its highlighter, set up like a window's."""
+    document = QtGui.QTextDocument()
+    document.setDocumentLayout(QtWidgets.QPlainTextDocumentLayout(document))
+    highlighter = Highlighter(document, lambda: QtGui.QColor('white'),
+                              lambda word, language: True,
+                              lambda language: True, lambda: [])
+    highlighter.setting_changed('chapter-keyword', 'CHAPTER')
+    highlighter.init_done()
+    return document, highlighter
+
+
+@pytest.fixture(scope='session')
+def qapp() -> Iterator[QtWidgets.QApplication]:
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    yield app
+
+
+@pytest.fixture
+def highlighter(qapp: QtWidgets.QApplication) -> Iterator[Highlighter]:
+    # The highlighter is deleted along with its document
+    document, highlighter = _make_highlighter()
+    yield highlighter
+
+
+@pytest.fixture
+def make_document(qapp: QtWidgets.QApplication
+                  ) -> Iterator[Callable[[str], QtGui.QTextDocument]]:
+    """Return a function that makes highlighted documents."""
+    # The documents are only highlighted while their highlighters exist
+    highlighters: List[Highlighter] = []
+
+    def make(text: str) -> QtGui.QTextDocument:
+        document, highlighter = _make_highlighter()
+        highlighters.append(highlighter)
+        # Setting the text highlights the whole document right away
+        document.setPlainText(text)
+        return document
+    yield make
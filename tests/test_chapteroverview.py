@@ -0,0 +1,120 @@
+from typing import Callable, Iterator, List, Tuple
+
+import pytest
+from PyQt5 import QtGui, QtWidgets
+
+from kalpana.chapteroverview import ChapterItem, ChapterOverview
+from kalpana.chapters import ChapterIndex
+
+
+def chapters_text(count: int) -> str:
+    return '\n'.join(f'CHAPTER {num}\n[[ desc {num} ]]\nsome words'
+                     for num in range(count))
+
+
+@pytest.fixture
+def overview(qapp: QtWidgets.QApplication
+             ) -> Iterator[Tuple[ChapterIndex, ChapterOverview]]:
+    parent = QtWidgets.QWidget()
+    index = ChapterIndex()
+    overview = ChapterOverview(parent, index)
+    index.chapters_changed.connect(overview.chapters_changed)
+    index.chapters_inserted.connect(overview.chapters_inserted)
+    index.chapters_removed.connect(overview.chapters_removed)
+    overview.resize(300, 400)
+    parent.show()
+    yield index, overview
+    parent.close()
+
+
+def check_visible_items(index: ChapterIndex, overview: ChapterOverview) -> None:
+    overview.layout_items()
+    assert overview.visible_items
+    for row, item in overview.visible_items.items():
+        assert item.isVisible()
+        assert item.chapter is index.chapters[row + 1]
+        assert item.index == row
+
+
+def test_only_visible_chapters_have_items(
+        overview: Tuple[ChapterIndex, ChapterOverview],
+        make_document: Callable[[str], QtGui.QTextDocument]) -> None:
+    index, overview_ = overview
+    index.full_line_index_update(make_document(chapters_text(1000)))
+    check_visible_items(index, overview_)
+    assert len(overview_.row_heights) == 1000
+    assert len(overview_.findChildren(ChapterItem)) < 50
+    scrollbar = overview_.verticalScrollBar()
+    scrollbar.setValue(scrollbar.maximum())
+    check_visible_items(index, overview_)
+    assert 999 in overview_.visible_items
+    assert len(overview_.findChildren(ChapterItem)) < 50
+
+
+def replace_lines(document: QtGui.QTextDocument, first: int, count: int,
+                  text: str) -> None:
+    cursor = QtGui.QTextCursor(document.findBlockByNumber(first))
+    cursor.setPosition(document.findBlockByNumber(first + count).position(),
+                       QtGui.QTextCursor.KeepAnchor)
+    cursor.insertText(text)
+
+
+@pytest.mark.parametrize('first,count,text,notices', [
+    # Insert a chapter before the third chapter
+    (6, 0, 'CHAPTER new\n', [('inserted', 3, 1)]),
+    # Remove the second and third chapters
+    (3, 6, '', [('removed', 2, 2)]),
+    # Change the words of the second chapter
+    (5, 1, 'other words here\n', [('changed', 2, 1)]),
+    # Replace a chapter with two new ones
+    (3, 3, 'CHAPTER a\nCHAPTER b\n', [('changed', 2, 1), ('inserted', 3, 1)]),
+])
+def test_full_index_sends_only_the_changes(
+        make_document: Callable[[str], QtGui.QTextDocument],
+        first: int, count: int, text: str,
+        notices: List[Tuple[str, int, int]]) -> None:
+    document = make_document(chapters_text(5))
+    index = ChapterIndex()
+    index.full_line_index_update(document)
+    old_chapters = index.chapters
+    sent: List[Tuple[str, int, int]] = []
+    for name in ['changed', 'inserted', 'removed']:
+        getattr(index, f'chapters_{name}').connect(
+            lambda first, count, name=name: sent.append((name, first, count)))
+    replace_lines(document, first, count, text)
+    index.full_line_index_update(document)
+    assert sent == notices
+    # Applying the notices to the old chapters gives the new ones
+    chapters = list(old_chapters)
+    for name, first, count in sent:
+        if name == 'removed':
+            del chapters[first:first + count]
+        else:
+            end = first + count if name == 'changed' else first
+            chapters[first:end] = index.chapters[first:first + count]
+    assert chapters == index.chapters
+
+
+def test_overview_rows_follow_inserted_and_removed_chapters(
+        overview: Tuple[ChapterIndex, ChapterOverview],
+        make_document: Callable[[str], QtGui.QTextDocument]) -> None:
+    index, overview_ = overview
+    document = make_document(chapters_text(5))
+    index.full_line_index_update(document)
+    overview_.set_expanded(3, True)
+    check_visible_items(index, overview_)
+    # Insert a chapter before the expanded one
+    replace_lines(document, 6, 0, 'CHAPTER new\n')
+    index.full_line_index_update(document)
+    assert overview_.expanded_chapters == {4}
+    assert len(overview_.row_heights) == 6
+    check_visible_items(index, overview_)
+    assert overview_.visible_items[4].expanded
+    # Remove the new chapter and the one before it
+    replace_lines(document, 3, 4, '')
+    index.full_line_index_update(document)
+    assert overview_.expanded_chapters == {2}
+    assert len(overview_.row_heights) == 4
+    check_visible_items(index, overview_)
+    assert overview_.visible_items[2].expanded
+    assert not overview_.visible_items[1].expanded
@@ -0,0 +1,284 @@
+import random
+from typing import Callable, List, Tuple
+
+import pytest
+from PyQt5 import QtGui
+
+from kalpana.chapters import (Chapter, ChapterIndex, FenwickTree, index_text,
+                              merge_changes)
+
+TEXT = '\n'.join([
+    'intro',
+    '',
+    'CHAPTER One ✓',
+    '[[ the desc ]]',
+    '#a, #b',
+    'some words here',
+    '<< part two >>',
+    'more words',
+    'CHAPTER Two',
+    'last',
+])
+
+# Snippets that are likely to change the structure of the chapters
+SNIPPETS = ['\n', 'x', 'word ', '\n\n', 'CHAPTER z\n', '<< s t >>\n',
+            '[[ a b ]]\n', '#t, #u\n', '🎉', 'a\nb']
+
+
+def random_text(rng: random.Random, chapters: int) -> str:
+    lines = ['intro words here', '']
+    for num in range(chapters):
+        lines.append(f'CHAPTER {num} title')
+        if rng.random() < 0.5:
+            lines.append('[[ desc ]]')
+        if rng.random() < 0.5:
+            lines.append('#tag, #foo')
+        for section in range(rng.randint(0, 3)):
+            lines += ['some words go here'] * rng.randint(0, 4)
+            lines.append(f'<< section {section} >>')
+        lines += ['body text with 🎉 emoji', 'more text'] * rng.randint(0, 3)
+    return '\n'.join(lines)
+
+
+def random_edit(rng: random.Random, document: QtGui.QTextDocument) -> None:
+    cursor = QtGui.QTextCursor(document)
+    end = document.characterCount() - 1
+    pos = rng.randint(0, end)
+    cursor.setPosition(pos)
+    if rng.random() < 0.5:
+        cursor.insertText(rng.choice(SNIPPETS))
+    else:
+        cursor.setPosition(min(end, pos + rng.randint(1, 5)),
+                           QtGui.QTextCursor.KeepAnchor)
+        if rng.random() < 0.5:
+            cursor.removeSelectedText()
+        else:
+            cursor.insertText(rng.choice(SNIPPETS))
+
+
+def structure(chapters: List[Chapter]) -> List[Tuple[object, ...]]:
+    return [(c.title, c.metadata_line_count,
+             [(s.line_count, s.word_count, s.desc) for s in c.sections])
+            for c in chapters]
+
+
+# == FenwickTree ==
+
+def test_fenwick_tree_matches_a_list() -> None:
+    rng = random.Random(1)
+    values = [rng.randint(0, 10) for _ in range(50)]
+    tree = FenwickTree(values)
+    for _ in range(200):
+        index = rng.randrange(len(values))
+        delta = rng.randint(-values[index], 10)
+        values[index] += delta
+        tree.add(index, delta)
+        assert len(tree) == len(values)
+        for i in range(len(values) + 1):
+            assert tree.prefix_sum(i) == sum(values[:i])
+        for target in range(-1, sum(values) + 2):
+            expected = next((i for i in range(len(values))
+                             if sum(values[:i + 1]) > target), len(values))
+            assert tree.search(target) == expected
+
+
+def test_empty_fenwick_tree() -> None:
+    tree = FenwickTree()
+    assert len(tree) == 0
+    assert tree.prefix_sum(0) == 0
+    assert tree.search(0) == 0
+
+
+# == merge_changes ==
+
+def random_change(rng: random.Random, text: str) -> Tuple[int, int, str]:
+    pos = rng.randint(0, len(text))
+    return pos, rng.randint(0, len(text) - pos), 'x' * rng.randint(0, 5)
+
+
+def apply_change(text: str, change: Tuple[int, int, str]) -> str:
+    pos, removed, added = change
+    return text[:pos] + added + text[pos + removed:]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_merge_changes_covers_both_changes(seed: int) -> None:
+    rng = random.Random(seed)
+    for _ in range(200):
+        old_text = ''.join(rng.choice('abc\n') for _ in range(rng.randint(0, 20)))
+        first = random_change(rng, old_text)
+        text = apply_change(old_text, first)
+        second = random_change(rng, text)
+        text = apply_change(text, second)
+        start, removed, added = merge_changes(
+            (first[0], first[1], len(first[2])),
+            (second[0], second[1], len(second[2])))
+        assert len(text) == len(old_text) - removed + added
+        assert text == old_text[:start] + text[start:start + added] \
+            + old_text[start + removed:]
+
+
+def test_merge_changes_with_separate_changes() -> None:
+    assert merge_changes((10, 2, 3), (2, 1, 0)) == (2, 10, 10)
+    assert merge_changes((2, 1, 0), (10, 2, 3)) == (2, 11, 11)
+
+
+# == index_text/ChapterIndex ==
+
+def test_index_text() -> None:
+    chapters, block_states = index_text(TEXT, 'CHAPTER')
+    assert structure(chapters) == [
+        (None, 0, [(2, 1, None)]),
+        ('One', 3, [(1, 3, None), (2, 2, 'part two')]),
+        ('Two', 1, [(1, 1, None)]),
+    ]
+    assert chapters[1].complete
+    assert chapters[1].desc == 'the desc'
+    assert chapters[1].tags == {'a', 'b'}
+    assert sum(c.line_count for c in chapters) == TEXT.count('\n') + 1
+    assert set(block_states) == {2, 3, 4, 6, 8}
+
+
+def test_index_text_without_chapters() -> None:
+    chapters, block_states = index_text('just\nsome text', 'CHAPTER')
+    assert structure(chapters) == [(None, 0, [(2, 3, None)])]
+    assert block_states == {}
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_index_text_matches_the_document_index(
+        make_document: Callable[[str], QtGui.QTextDocument], seed: int) -> None:
+    text = random_text(random.Random(seed), 10)
+    index = ChapterIndex()
+    index.full_line_index_update(make_document(text))
+    chapters, _ = index_text(text, 'CHAPTER')
+    assert index.chapters == chapters
+    assert structure(index.chapters) == structure(chapters)
+
+
+def test_edit_section_line_right_after_chapter_metadata(
+        make_document: Callable[[str], QtGui.QTextDocument]) -> None:
+    # The chapter's first section is empty here
+    document = make_document('intro\nCHAPTER One\n<< first >>\ntext')
+    index = ChapterIndex()
+    index.full_line_index_update(document)
+    document.contentsChange.connect(
+        lambda pos, removed, added:
+        index.update_line_index(document, QtGui.QTextCursor(document),
+                                pos, removed, added))
+    cursor = QtGui.QTextCursor(document)
+    cursor.setPosition(document.findBlockByNumber(2).position() + len('<< first'))
+    cursor.insertText('er')
+    assert [s.desc for s in index.chapters[1].sections] == [None, 'firster']
+
+
+def test_split_line_into_a_section_line(
+        make_document: Callable[[str], QtGui.QTextDocument]) -> None:
+    document = make_document('intro\nCHAPTER One\nfirst\ntext << part >>\nmore')
+    index = ChapterIndex()
+    index.full_line_index_update(document)
+    document.contentsChange.connect(
+        lambda pos, removed, added:
+        index.update_line_index(document, QtGui.QTextCursor(document),
+                                pos, removed, added))
+    cursor = QtGui.QTextCursor(document)
+    cursor.setPosition(document.findBlockByNumber(3).position() + len('text '))
+    cursor.insertText('\n')
+    assert structure(index.chapters) == [
+        (None, 0, [(1, 1, None)]),
+        ('One', 1, [(2, 2, None), (2, 1, 'part')]),
+    ]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_incremental_index_matches_full_index(
+        make_document: Callable[[str], QtGui.QTextDocument], seed: int) -> None:
+    rng = random.Random(seed)
+    document = make_document(random_text(rng, rng.randint(0, 10)))
+    index = ChapterIndex()
+    index.full_line_index_update(document)
+    document.contentsChange.connect(
+        lambda pos, removed, added:
+        index.update_line_index(document, QtGui.QTextCursor(document),
+                                pos, removed, added))
+    for _ in range(60):
+        random_edit(rng, document)
+        full_index = ChapterIndex()
+        full_index.full_line_index_update(document)
+        index.update_word_counts(document)
+        assert structure(index.chapters) == structure(full_index.chapters)
+        assert index.chapter_line_numbers == full_index.chapter_line_numbers
+        assert index.total_word_count == full_index.total_word_count
+        for line in range(document.blockCount()):
+            assert index.which_chapter(line) == full_index.which_chapter(line)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_total_word_count_includes_every_line(
+        make_document: Callable[[str], QtGui.QTextDocument], seed: int) -> None:
+    rng = random.Random(seed)
+    document = make_document(random_text(rng, 8))
+    index = ChapterIndex()
+    index.full_line_index_update(document)
+    document.contentsChange.connect(
+        lambda pos, removed, added:
+        index.update_line_index(document, QtGui.QTextCursor(document),
+                                pos, removed, added))
+    for _ in range(40):
+        random_edit(rng, document)
+        index.update_word_counts(document)
+        total = index.total_word_count + index.uncounted_word_count(document)
+        assert total == len(document.toPlainText().split())
+
+
+def apply_merged_changes(index: ChapterIndex, document: QtGui.QTextDocument,
+                         changes: List[Tuple[int, int, int]]) -> None:
+    """Update the index like the controller does after an event loop tick."""
+    if not changes:
+        return
+    change = changes[0]
+    for next_change in changes[1:]:
+        change = merge_changes(change, next_change)
+    changes.clear()
+    index.update_line_index(document, QtGui.QTextCursor(document), *change)
+
+
+def test_merged_changes_that_split_and_rejoin_a_line(
+        make_document: Callable[[str], QtGui.QTextDocument]) -> None:
+    document = make_document('one\nPTCHAP[[ word z\nend')
+    index = ChapterIndex()
+    index.full_line_index_update(document)
+    changes: List[Tuple[int, int, int]] = []
+    document.contentsChange.connect(
+        lambda pos, removed, added: changes.append((pos, removed, added)))
+    cursor = QtGui.QTextCursor(document)
+    cursor.setPosition(5)
+    cursor.setPosition(9, QtGui.QTextCursor.KeepAnchor)
+    cursor.insertText('\n\n')
+    cursor.setPosition(4)
+    cursor.setPosition(9, QtGui.QTextCursor.KeepAnchor)
+    cursor.insertText('x')
+    apply_merged_changes(index, document, changes)
+    index.update_word_counts(document)
+    assert index.total_word_count == len(document.toPlainText().split())
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_merged_index_updates_match_full_index(
+        make_document: Callable[[str], QtGui.QTextDocument], seed: int) -> None:
+    rng = random.Random(seed)
+    document = make_document(random_text(rng, rng.randint(0, 10)))
+    index = ChapterIndex()
+    index.full_line_index_update(document)
+    changes: List[Tuple[int, int, int]] = []
+    document.contentsChange.connect(
+        lambda pos, removed, added: changes.append((pos, removed, added)))
+    for _ in range(60):
+        for _ in range(rng.randint(1, 4)):
+            random_edit(rng, document)
+        apply_merged_changes(index, document, changes)
+        full_index = ChapterIndex()
+        full_index.full_line_index_update(document)
+        index.update_word_counts(document)
+        assert structure(index.chapters) == structure(full_index.chapters)
+        assert index.total_word_count == full_index.total_word_count
@@ -0,0 +1,126 @@
+import os
+from pathlib import Path
+from typing import List
+
+import pytest
+from PyQt5 import QtGui, QtWidgets
+
+from kalpana.filehandler import (DEFAULT_FILE_MODE, FileHandler, decode_text,
+                                 write_file_safely)
+from kalpana.recovery import RecoveryJournal
+
+
+@pytest.mark.parametrize('data,text,encoding', [
+    (b'', '', 'utf-8'),
+    (b'plain ascii', 'plain ascii', 'utf-8'),
+    ('åäö 🎉'.encode('utf-8'), 'åäö 🎉', 'utf-8'),
+    ('åäö'.encode('latin1'), 'åäö', 'latin1'),
+    # Valid utf-8 apart from the last byte
+    ('åäö'.encode('utf-8') + b'\xff', 'Ã¥Ã¤Ã¶ÿ', 'latin1'),
+])
+def test_decode_text_encoding(data: bytes, text: str, encoding: str) -> None:
+    assert decode_text(data) == (text, encoding)
+
+
+@pytest.mark.parametrize('data,text', [
+    (b'a\nb\n', 'a\nb\n'),
+    (b'a\r\nb\r\n', 'a\nb\n'),
+    (b'a\rb\r', 'a\nb\n'),
+    (b'a\r\n\rb\n\r\n', 'a\n\nb\n\n'),
+    ('å\r\nä'.encode('latin1'), 'å\nä'),
+])
+def test_decode_text_newlines(data: bytes, text: str) -> None:
+    assert decode_text(data)[0] == text
+
+
+def test_write_file_safely_replaces_the_file(tmp_path: Path) -> None:
+    filepath = tmp_path / 'file.txt'
+    filepath.write_text('old text', encoding='utf-8')
+    filepath.chmod(0o600)
+    write_file_safely(str(filepath), 'new text 🎉')
+    assert filepath.read_text(encoding='utf-8') == 'new text 🎉'
+    assert filepath.stat().st_mode & 0o777 == 0o600
+    assert os.listdir(tmp_path) == ['file.txt']
+
+
+def test_write_file_safely_creates_new_files(tmp_path: Path) -> None:
+    filepath = tmp_path / 'new.txt'
+    write_file_safely(str(filepath), 'text')
+    assert filepath.read_text(encoding='utf-8') == 'text'
+    assert filepath.stat().st_mode & 0o777 == DEFAULT_FILE_MODE
+
+
+def test_write_file_safely_follows_symlinks(tmp_path: Path) -> None:
+    filepath = tmp_path / 'file.txt'
+    filepath.write_text('old text', encoding='utf-8')
+    link = tmp_path / 'link.txt'
+    link.symlink_to(filepath)
+    write_file_safely(str(link), 'new text')
+    assert link.is_symlink()
+    assert filepath.read_text(encoding='utf-8') == 'new text'
+
+
+def test_write_file_safely_failing_to_write(tmp_path: Path) -> None:
+    filepath = tmp_path / 'file.txt'
+    filepath.write_text('old text', encoding='utf-8')
+    # A lone surrogate can't be encoded as utf-8
+    with pytest.raises(UnicodeEncodeError):
+        write_file_safely(str(filepath), 'new text \ud800')
+    assert filepath.read_text(encoding='utf-8') == 'old text'
+    assert os.listdir(tmp_path) == ['file.txt']
+
+
+def test_write_file_safely_failing_to_replace(
+        tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    filepath = tmp_path / 'file.txt'
+    filepath.write_text('old text', encoding='utf-8')
+
+    def replace(src: str, dst: str) -> None:
+        raise OSError('replace failed')
+    monkeypatch.setattr(os, 'replace', replace)
+    with pytest.raises(OSError):
+        write_file_safely(str(filepath), 'new text')
+    assert filepath.read_text(encoding='utf-8') == 'old text'
+    assert os.listdir(tmp_path) == ['file.txt']
+
+
+def test_write_file_safely_in_a_missing_directory(tmp_path: Path) -> None:
+    with pytest.raises(FileNotFoundError):
+        write_file_safely(str(tmp_path / 'missing' / 'file.txt'), 'text')
+
+
+def test_failed_save_after_another_save_keeps_the_changes(
+        qapp: QtWidgets.QApplication, tmp_path: Path) -> None:
+    filepath = tmp_path / 'file.txt'
+    filepath.write_text('old text', encoding='utf-8')
+    os.utime(filepath, ns=(0, 0))
+    document = QtGui.QTextDocument()
+    document.setDocumentLayout(QtWidgets.QPlainTextDocumentLayout(document))
+    document.setPlainText('old text')
+    filehandler = FileHandler(document.toPlainText, document.isModified,
+                              document.revision)
+    filehandler.document_saved.connect(lambda: document.setModified(False))
+    journal = RecoveryJournal(tmp_path / 'config', document)
+    document.contentsChange.connect(journal.contents_changed)
+    filehandler.file_saved_signal.connect(journal.file_saved)
+    errors: List[str] = []
+    filehandler.error_signal.connect(errors.append)
+    filehandler.filepath = str(filepath)
+    journal.file_opened(str(filepath), False)
+    cursor = QtGui.QTextCursor(document)
+    cursor.insertText('first ')
+    filehandler.save_file(None)
+    cursor.insertText('second ')
+    # The directory doesn't exist, so this save fails
+    filehandler.save_file(str(tmp_path / 'missing' / 'file.txt'))
+    filehandler.wait_for_saves()
+    journal.wait_for_writes()
+    assert len(errors) == 1
+    assert filepath.read_text(encoding='utf-8') == 'first old text'
+    assert filehandler.filepath == str(filepath)
+    assert document.isModified()
+    # The second change can still be recovered
+    document.setPlainText('first old text')
+    assert journal.recovered_text() == 'first second old text'
+    journal.close()
+    filehandler.close()
@@ -0,0 +1,117 @@
+from typing import List, Tuple
+
+import pytest
+from PyQt5 import QtCore, QtGui
+
+from kalpana.highlighter import (LANGUAGE_SHIFT, TBS, Highlighter,
+                                 UTF16Positions)
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    'plain text',
+    '🎉',
+    'a🎉b',
+    '🎉🎉 x 🎉 y𝒜z',
+])
+def test_utf16_positions(text: str) -> None:
+    positions = UTF16Positions(text)
+    for index in range(len(text) + 1):
+        assert positions.pos(index) == utf16_length(text[:index])
+    assert positions.length == utf16_length(text)
+
+
+def test_utf16_positions_without_astral_chars() -> None:
+    positions = UTF16Positions('åäö – “bmp only”')
+    assert positions.astral_chars == []
+    assert positions.pos(5) == 5
+
+
+@pytest.mark.parametrize('text,markers', [
+    ('/italic/ text', [(0, '/'), (7, '/')]),
+    ('*bold* _under_', [(0, '*'), (5, '*'), (7, '_'), (13, '_')]),
+    ('and/or', []),
+    ('a//b', []),
+    ('🎉 /x/ 🎉', [(2, '/'), (4, '/')]),
+    ('𝒜/b/𝒜', []),
+    ('🎉🎉 *x* 🎉 /y/', [(3, '*'), (5, '*'), (9, '/'), (11, '/')]),
+])
+def test_find_markers(highlighter: Highlighter, text: str,
+                      markers: List[Tuple[int, str]]) -> None:
+    assert highlighter.find_markers(text) == markers
+
+
+def test_find_markers_in_utf16(highlighter: Highlighter) -> None:
+    text = '🎉 some /italic/ 🎉 *bold*'
+    positions = UTF16Positions(text)
+    utf16_text = text.encode('utf-16-le')
+    for pos, marker in highlighter.find_markers(text):
+        start = positions.pos(pos) * 2
+        assert utf16_text[start:start + 2].decode('utf-16-le') == marker
+
+
+def test_only_installed_languages_use_up_state_bits(
+        highlighter: Highlighter) -> None:
+    highlighter.language_exists = lambda language: language in {'sv', 'sv_SE'}
+    cursor = QtGui.QTextCursor(highlighter.document())
+    cursor.insertText('%% lang: ')
+    # Like typing the language name
+    for char in 'sv_SE':
+        cursor.insertText(char)
+    assert highlighter.languages == ['', 'sv', 'sv_SE']
+    assert highlighter.block_language(cursor.block()) == 'sv_SE'
+    cursor.insertText('x')
+    assert highlighter.block_language(cursor.block()) == ''
+
+
+def test_unused_languages_are_freed_when_the_state_bits_run_out(
+        highlighter: Highlighter) -> None:
+    errors: List[str] = []
+    highlighter.error_signal.connect(errors.append)
+    max_languages = (TBS.LANGUAGE >> LANGUAGE_SHIFT) + 1
+    cursor = QtGui.QTextCursor(highlighter.document())
+    cursor.insertText('%% lang: ')
+    for num in range(max_languages):
+        cursor.movePosition(QtGui.QTextCursor.EndOfBlock)
+        cursor.movePosition(QtGui.QTextCursor.StartOfBlock,
+                            QtGui.QTextCursor.KeepAnchor)
+        cursor.insertText(f'%% lang: l{num}')
+    assert highlighter.block_language(cursor.block()) == f'l{max_languages - 1}'
+    assert len(highlighter.languages) == max_languages
+    assert errors == []
+    # Every slot is in use when each line has its own language
+    cursor.movePosition(QtGui.QTextCursor.End)
+    for num in range(max_languages):
+        cursor.insertText(f'\n%% lang: m{num}')
+    assert highlighter.block_language(cursor.block()) == ''
+    assert errors == [f'Too many spellcheck languages, using the default '
+                      f'language instead of m{max_languages - 2}',
+                      f'Too many spellcheck languages, using the default '
+                      f'language instead of m{max_languages - 1}']
+
+
+def test_rehighlight_chunks_keep_their_place_after_edits(
+        highlighter: Highlighter) -> None:
+    document = highlighter.document()
+    lines = [f'line {num}' for num in range(100)]
+    document.setPlainText('\n'.join(lines))
+    rehighlighted: List[str] = []
+    highlighter.rehighlightBlock = (  # type: ignore
+        lambda block: rehighlighted.append(block.text()))
+    highlighter.get_visible_blocks = lambda: [
+        (QtCore.QRectF(), document.findBlockByNumber(num))
+        for num in range(10, 20)]
+    # Only one block is rehighlighted in each chunk
+    highlighter.rehighlight_time_slice = 0
+    highlighter.rehighlight()
+    for _ in range(5):
+        highlighter.rehighlight_chunk()
+    assert rehighlighted == lines[10:20] + lines[:5]
+    QtGui.QTextCursor(document).insertText('new\nlines\n')
+    while highlighter.rehighlight_timer.isActive():
+        highlighter.rehighlight_chunk()
+    assert rehighlighted == lines[10:20] + lines[:10] + lines[20:]
@@ -0,0 +1,100 @@
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Callable, Iterator, List
+
+import pytest
+from PyQt5 import QtNetwork, QtWidgets
+
+from kalpana.kalpana import Kalpana, send_files_to_running_instance, server_name
+
+
+class Instance:
+    """The part of a Kalpana that other Kalpanas send their files to."""
+    listen = Kalpana.listen
+    receive_files = Kalpana.receive_files
+
+    def __init__(self, config_dir: Path) -> None:
+        self.config_dir = config_dir
+        self.server = QtNetwork.QLocalServer()
+        self.server.setSocketOptions(QtNetwork.QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self.receive_files)
+        self.opened_files: List[str] = []
+
+    def open_window(self, file_to_open: str) -> None:
+        self.opened_files.append(file_to_open)
+
+
+@pytest.fixture
+def make_instance(qapp: QtWidgets.QApplication, tmp_path: Path
+                  ) -> Iterator[Callable[[], Instance]]:
+    instances: List[Instance] = []
+
+    def make() -> Instance:
+        instance = Instance(tmp_path)
+        instances.append(instance)
+        return instance
+    yield make
+    for instance in instances:
+        instance.server.close()
+
+
+def wait_for(qapp: QtWidgets.QApplication, condition: Callable[[], bool]) -> None:
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        qapp.processEvents()
+    assert condition()
+
+
+def test_files_are_sent_to_the_running_instance(
+        qapp: QtWidgets.QApplication, tmp_path: Path,
+        make_instance: Callable[[], Instance]) -> None:
+    instance = make_instance()
+    instance.listen()
+    name = server_name(tmp_path)
+    assert send_files_to_running_instance(name, ['file.txt', '/a/b'])
+    wait_for(qapp, lambda: len(instance.opened_files) == 2)
+    assert instance.opened_files == [os.path.abspath('file.txt'), '/a/b']
+    # No files means a new window without a file
+    assert send_files_to_running_instance(name, [])
+    wait_for(qapp, lambda: len(instance.opened_files) == 3)
+    assert instance.opened_files[-1] == ''
+
+
+def test_nothing_is_sent_without_a_running_instance(
+        qapp: QtWidgets.QApplication, tmp_path: Path) -> None:
+    assert not send_files_to_running_instance(server_name(tmp_path), ['x'])
+
+
+def test_second_instance_leaves_the_running_one_alone(
+        qapp: QtWidgets.QApplication, tmp_path: Path,
+        make_instance: Callable[[], Instance]) -> None:
+    first = make_instance()
+    first.listen()
+    second = make_instance()
+    second.listen()
+    assert first.server.isListening()
+    assert not second.server.isListening()
+    assert send_files_to_running_instance(server_name(tmp_path), ['x'])
+    wait_for(qapp, lambda: bool(first.opened_files))
+    # The second instance's check didn't open anything
+    qapp.processEvents()
+    assert first.opened_files == [os.path.abspath('x')]
+
+
+def test_socket_left_by_a_crashed_instance_is_replaced(
+        qapp: QtWidgets.QApplication, tmp_path: Path,
+        make_instance: Callable[[], Instance]) -> None:
+    instance = make_instance()
+    instance.listen()
+    path = instance.server.fullServerName()
+    instance.server.close()
+    # A socket file that nothing listens on, like after a crash
+    with socket.socket(socket.AF_UNIX) as stale_socket:
+        stale_socket.bind(path)
+    instance = make_instance()
+    instance.listen()
+    assert instance.server.isListening()
+    assert send_files_to_running_instance(server_name(tmp_path), ['x'])
+    wait_for(qapp, lambda: bool(instance.opened_files))
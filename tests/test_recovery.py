@@ -0,0 +1,91 @@
+import os
+import random
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from PyQt5 import QtGui, QtWidgets
+
+from kalpana.recovery import RecoveryJournal, replay_changes
+
+TEXT = 'first line\nsecond 🎉 line\n\nlast 𝒜 line'
+
+
+@pytest.fixture
+def document(qapp: QtWidgets.QApplication) -> QtGui.QTextDocument:
+    document = QtGui.QTextDocument()
+    # Without a layout, contentsChange is never emitted
+    document.setDocumentLayout(QtWidgets.QPlainTextDocumentLayout(document))
+    document.setPlainText(TEXT)
+    return document
+
+
+@pytest.fixture
+def journal(tmp_path: Path, document: QtGui.QTextDocument
+            ) -> Iterator[RecoveryJournal]:
+    filepath = tmp_path / 'file.txt'
+    filepath.write_text(TEXT, encoding='utf-8')
+    # The journal has to be newer than the file to be used
+    os.utime(filepath, ns=(0, 0))
+    journal = RecoveryJournal(tmp_path / 'config', document)
+    document.contentsChange.connect(journal.contents_changed)
+    journal.file_opened(str(filepath), False)
+    yield journal
+    journal.close()
+
+
+def random_edits(rng: random.Random, document: QtGui.QTextDocument,
+                 count: int) -> None:
+    cursor = QtGui.QTextCursor(document)
+    for _ in range(count):
+        # Move by characters to never end up inside a surrogate pair
+        cursor.movePosition(QtGui.QTextCursor.Start)
+        cursor.movePosition(QtGui.QTextCursor.NextCharacter,
+                            n=rng.randint(0, len(document.toPlainText())))
+        cursor.movePosition(QtGui.QTextCursor.NextCharacter,
+                            QtGui.QTextCursor.KeepAnchor, rng.randint(0, 4))
+        cursor.insertText(rng.choice(['', 'x', '🎉', '\n', 'a\nb', '𝒜 z']))
+
+
+def test_replay_changes() -> None:
+    assert replay_changes('abc', []) == 'abc'
+    assert replay_changes('abc', [(1, 1, 'xy')]) == 'axyc'
+    assert replay_changes('abc', [(0, 0, 'x\n'), (4, 1, '')]) == 'x\nab'
+    # Positions past the end of the text stop at the end
+    assert replay_changes('abc', [(10, 5, '!')]) == 'abc!'
+
+
+def test_replay_changes_uses_utf16_positions() -> None:
+    # The emoji takes up two positions in the document
+    assert replay_changes('🎉ab', [(2, 1, 'x')]) == '🎉xb'
+    assert replay_changes('a🎉b', [(1, 2, '')]) == 'ab'
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_replay_recorded_changes(journal: RecoveryJournal,
+                                 document: QtGui.QTextDocument,
+                                 seed: int) -> None:
+    random_edits(random.Random(seed), document, 50)
+    assert replay_changes(TEXT, journal.changes) == document.toPlainText()
+
+
+def test_recovered_text(journal: RecoveryJournal,
+                        document: QtGui.QTextDocument) -> None:
+    random_edits(random.Random(0), document, 20)
+    edited_text = document.toPlainText()
+    journal.wait_for_writes()
+    # Like opening the file again after a crash
+    document.setPlainText(TEXT)
+    assert journal.recovered_text() == edited_text
+
+
+def test_discarded_changes_remove_the_journal(
+        journal: RecoveryJournal, document: QtGui.QTextDocument) -> None:
+    random_edits(random.Random(0), document, 5)
+    journal.wait_for_writes()
+    assert journal.journal_path is not None
+    assert journal.journal_path.exists()
+    journal.discard_changes()
+    assert not journal.journal_path.exists()
+    document.setPlainText(TEXT)
+    assert journal.recovered_text() is None
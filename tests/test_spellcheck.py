@@ -0,0 +1,93 @@
+import json
+from pathlib import Path
+from typing import List
+
+import pytest
+from PyQt5 import QtWidgets
+
+from kalpana.spellcheck import (MIN_WORD_CACHE_SIZE, SpellcheckDictionaries,
+                                Spellchecker)
+
+
+def make_dictionaries(tmp_path: Path) -> SpellcheckDictionaries:
+    dictionaries = SpellcheckDictionaries(tmp_path / 'config')
+    dictionaries.dictionary_dirs = [tmp_path / 'dicts']
+    return dictionaries
+
+
+@pytest.fixture
+def dictionaries(qapp: QtWidgets.QApplication,
+                 tmp_path: Path) -> SpellcheckDictionaries:
+    (tmp_path / 'dicts').mkdir()
+    (tmp_path / 'dicts' / 'xx.dic').write_text('1\nword\n', encoding='utf-8')
+    (tmp_path / 'dicts' / 'xx.aff').write_text('SET UTF-8\n', encoding='utf-8')
+    dictionaries = make_dictionaries(tmp_path)
+    dictionaries.load_word_cache('xx')
+    dictionaries.add_checked_words('xx', {'word': True, 'wrod': False})
+    dictionaries.save_word_cache('xx')
+    return dictionaries
+
+
+def test_saved_word_cache_is_loaded(dictionaries: SpellcheckDictionaries,
+                                    tmp_path: Path) -> None:
+    word_cache = make_dictionaries(tmp_path).load_word_cache('xx')
+    assert dict(word_cache) == {'word': True, 'wrod': False}
+
+
+def test_changed_dictionary_outdates_the_word_cache(
+        dictionaries: SpellcheckDictionaries, tmp_path: Path) -> None:
+    with (tmp_path / 'dicts' / 'xx.dic').open('a', encoding='utf-8') as f:
+        f.write('wrod\n')
+    assert not make_dictionaries(tmp_path).load_word_cache('xx')
+
+
+def test_changed_word_list_outdates_the_word_cache(
+        dictionaries: SpellcheckDictionaries, tmp_path: Path) -> None:
+    (tmp_path / 'config' / 'spellcheck-pwl' / 'xx.pwl').write_text(
+        'wrod\n', encoding='utf-8')
+    assert not make_dictionaries(tmp_path).load_word_cache('xx')
+
+
+def test_word_cache_without_dictionary_files_expires(
+        dictionaries: SpellcheckDictionaries, tmp_path: Path) -> None:
+    dictionaries.dictionary_dirs = []
+    dictionaries.save_word_cache('xx')
+    new_dictionaries = make_dictionaries(tmp_path)
+    new_dictionaries.dictionary_dirs = []
+    assert new_dictionaries.load_word_cache('xx')
+    cache_file = tmp_path / 'config' / 'spellcheck-cache' / 'xx.json'
+    data = json.loads(cache_file.read_text(encoding='utf-8'))
+    data['created'] -= 30 * 24 * 60 * 60
+    cache_file.write_text(json.dumps(data), encoding='utf-8')
+    assert not new_dictionaries.load_word_cache('xx')
+
+
+def test_word_cache_drops_the_least_recently_used_words(
+        dictionaries: SpellcheckDictionaries) -> None:
+    dictionaries.request_word_cache_size(None, 3)
+    assert dictionaries.check_word('word', 'xx') is True
+    dictionaries.add_checked_words('xx', {'a': True})
+    assert list(dictionaries.word_caches['xx']) == ['wrod', 'word', 'a']
+    dictionaries.add_checked_words('xx', {'b': False})
+    assert list(dictionaries.word_caches['xx']) == ['word', 'a', 'b']
+    assert dictionaries.check_word('wrod', 'xx') is None
+    assert dictionaries.word_cache_evictions == 1
+
+
+def test_word_cache_size_is_the_biggest_of_all_windows(
+        dictionaries: SpellcheckDictionaries) -> None:
+    errors: List[str] = []
+    spellcheckers = []
+    for size in [20000, 50000, 30000, 100]:
+        spellchecker = Spellchecker(dictionaries, lambda: None, lambda: '')
+        spellchecker.error_signal.connect(errors.append)
+        spellchecker.setting_changed('spellcheck-cache-size', size)
+        spellcheckers.append(spellchecker)
+    # The last one is too small and is ignored
+    assert errors == [f'Spellcheck cache size has to be at least '
+                      f'{MIN_WORD_CACHE_SIZE}!']
+    assert dictionaries.word_cache_size == 50000
+    spellcheckers[1].close()
+    assert dictionaries.word_cache_size == 30000
+    spellcheckers[2].setting_changed('spellcheck-cache-size', 10000)
+    assert dictionaries.word_cache_size == 20000